@@ -1,5 +1,6 @@
 from flask import Flask, jsonify
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, SecondaryPreferred
 from config import Config
 
 #import endpoints
@@ -10,28 +11,136 @@ from routes.account_routes import accounts_bp, init_account_routes
 from routes.warehouse_routes import warehouses_bp, init_warehouse_routes
 
 #import controllers
-from routes.stock_manager import stock_manager_bp
+from routes.stock_manager import stock_manager_bp, init_stock_manager_routes, add_stock_listener
+from routes.invoice_writer import InvoiceWriter
+from routes.wine_similarity import WineSimilarityIndex
+from routes.query_cache import QueryCache
+from routes.invalidation_bus import InvalidationBus
+from routes.catalog_sync import STOCK_CHANGE, CatalogChangeLog, CatalogSnapshot
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config.from_object(Config)
 
-# Initialize MongoDB client with the configured URI
-client = MongoClient(app.config["MONGO_URI"])
+#read preferences accepted by CATALOG_READ_PREFERENCE, besides "primary"
+READ_PREFERENCES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
+
+# Initialize MongoDB client with the configured URI; everything reads from the primary unless routed elsewhere
+client = MongoClient(
+    app.config["MONGO_URI"],
+    minPoolSize=app.config["MONGO_MIN_POOL_SIZE"],
+    readPreference="primary"
+)
+
+# Catalog browsing may read from secondaries lagging at most CATALOG_MAX_STALENESS_SECONDS
+if app.config["CATALOG_READ_PREFERENCE"] == "primary":
+    catalog_read_preference = ReadPreference.PRIMARY
+    catalog_max_staleness = None
+else:
+    catalog_read_preference = READ_PREFERENCES[app.config["CATALOG_READ_PREFERENCE"]](
+        max_staleness=app.config["CATALOG_MAX_STALENESS_SECONDS"]
+    )
+    catalog_max_staleness = app.config["CATALOG_MAX_STALENESS_SECONDS"] if app.config["CATALOG_MAX_STALENESS_SECONDS"] > 0 else None
 db = client['wine_warehouse']  # Replace 'wine_warehouse' with your actual database name
 
 wines_collection = db['wines']  # Collection where wine data is stored
 purchases_collection = db['purchases'] # Collection for purchase records
 accounts_collection = db['accounts'] # collection for user accounts
+account_flags_collection = db['account_flags'] # one-time flags such as the admin bootstrap
 warehouses_collection = db['warehouses'] # collection for warehouses
 sales_collection = db['sales'] # collection for sales
+reservations_collection = db['reservations'] # collection for cart stock holds
+
+# Background writer for invoices; replays invoices journaled but not stored before a restart
+invoice_writer = InvoiceWriter(
+    sales_collection,
+    app.config["INVOICE_JOURNAL_DIR"],
+    batch_size=app.config["INVOICE_BATCH_SIZE"],
+    fsync=app.config["INVOICE_JOURNAL_FSYNC"],
+    max_attempts=app.config["INVOICE_MAX_ATTEMPTS"]
+)
+invoice_writer.start()
+
+# Feature matrix for similar wine recommendations, built on first use
+similarity_index = WineSimilarityIndex(wines_collection)
+
+# Cache of catalog query results, invalidated by catalog and stock versions
+query_cache = QueryCache(app.config["QUERY_CACHE_MAX_BYTES"], max_age=catalog_max_staleness)
+
+# Invalidation events for writes made by other workers and hosts
+invalidation_bus = InvalidationBus(
+    db,
+    [wines_collection.name, warehouses_collection.name, reservations_collection.name],
+    db['cache_versions'],
+    poll_interval=app.config["INVALIDATION_POLL_SECONDS"]
+)
+
+# Change log and snapshots of the catalog, for clients keeping an offline copy
+catalog_changes = CatalogChangeLog(
+    db['catalog_changes'],
+    db['catalog_versions'],
+    retention_days=app.config["CATALOG_CHANGES_RETENTION_DAYS"]
+)
+catalog_changes.create_indexes()
+catalog_changes.start()
+catalog_snapshot = CatalogSnapshot(
+    wines_collection,
+    warehouses_collection,
+    catalog_changes,
+    app.config["CATALOG_SNAPSHOT_DIR"],
+    interval=app.config["CATALOG_SNAPSHOT_SECONDS"]
+)
+
+def on_stock_change(wine_ids):
+    query_cache.bump("stock")
+    # Stock listeners get wine ids, not the warehouse or reservation ids the change events carry,
+    # so no ids are published; polling processes bump "stock" for either collection
+    invalidation_bus.publish(warehouses_collection.name)
+
+def on_wines_changed(wine_ids):
+    query_cache.bump("catalog")
+    if wine_ids is None:
+        similarity_index.invalidate()
+    else:
+        similarity_index.refresh_many(wine_ids)
+
+add_stock_listener(on_stock_change)
+add_stock_listener(lambda wine_ids: catalog_changes.record_later(STOCK_CHANGE, wine_ids))
+invalidation_bus.subscribe(wines_collection.name, on_wines_changed)
+invalidation_bus.subscribe(warehouses_collection.name, lambda wine_ids: query_cache.bump("stock"))
+invalidation_bus.subscribe(reservations_collection.name, lambda wine_ids: query_cache.bump("stock"))
+invalidation_bus.start()
+catalog_snapshot.start()
 
 # Initialize route endpoints with their collection instances
-init_wine_routes(wines_collection, warehouses_collection)
-init_purchase_routes(purchases_collection)
-init_sale_routes(sales_collection, wines_collection, warehouses_collection)
-init_account_routes(accounts_collection)
-init_warehouse_routes(warehouses_collection)
+init_wine_routes(
+    wines_collection,
+    warehouses_collection,
+    reservations_collection,
+    similarity_index,
+    query_cache,
+    invalidation_bus,
+    catalog_changes,
+    catalog_snapshot,
+    catalog_read_preference
+)
+init_purchase_routes(purchases_collection, warehouses_collection, app.config["RECEIPT_CLAIM_TIMEOUT_SECONDS"])
+init_sale_routes(sales_collection, wines_collection, warehouses_collection, reservations_collection, invoice_writer, app.config["ALLOCATION_STRATEGY"])
+init_account_routes(accounts_collection, account_flags_collection)
+init_warehouse_routes(warehouses_collection, wines_collection, app.config["LOCATIONS_STREAM_THRESHOLD"])
+init_stock_manager_routes(
+    wines_collection,
+    warehouses_collection,
+    reservations_collection,
+    sales_collection,
+    purchases_collection,
+    app.config["RESERVATION_TTL_SECONDS"]
+)
 
 app.register_blueprint(wines_bp, url_prefix=app.config["BASE_URL"])
 app.register_blueprint(purchases_bp, url_prefix=app.config["BASE_URL"])
@@ -45,6 +154,13 @@ app.register_blueprint(stock_manager_bp, url_prefix=app.config["BASE_URL"])
 def index():
     return jsonify({"message": "Welcome to the Wine Warehouse API"}), 200
 
+# Prepare a new worker process before it accepts traffic
+def warm_up():
+    client.admin.command("ping")  # Connect and discover the deployment
+    similarity_index.ensure_built()
+    with app.test_client() as test_client:
+        test_client.get(app.config["BASE_URL"] + "/wines")  # Cache the landing page
+
 # Start the Flask app on all available IPs (host 0.0.0.0) on port 8888
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True, port=8888)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 from dotenv import load_dotenv
 
@@ -5,4 +6,30 @@ load_dotenv()
 
 class Config:
     MONGO_URI = os.getenv("MONGO_URI")
-    BASE_URL = "/v1/api"
\ No newline at end of file
+    BASE_URL = "/v1/api"
+    RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", 900))  # How long cart holds last
+    ALLOCATION_STRATEGY = os.getenv("ALLOCATION_STRATEGY", "single_warehouse")  # Default stock allocation for sales
+    INVOICE_JOURNAL_DIR = os.getenv("INVOICE_JOURNAL_DIR", "journal")  # On-disk journal of invoices waiting to be stored
+    INVOICE_BATCH_SIZE = int(os.getenv("INVOICE_BATCH_SIZE", 100))
+    INVOICE_JOURNAL_FSYNC = os.getenv("INVOICE_JOURNAL_FSYNC", "true").lower() == "true"
+    RECEIPT_CLAIM_TIMEOUT_SECONDS = int(os.getenv("RECEIPT_CLAIM_TIMEOUT_SECONDS", 300))  # After this, a purchase receipt left unfinished can be retried
+    INVOICE_MAX_ATTEMPTS = int(os.getenv("INVOICE_MAX_ATTEMPTS", 5))  # Attempts before rejected invoices go to the dead-letter file
+    QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # Memory bound of the catalog result cache
+    INVALIDATION_POLL_SECONDS = float(os.getenv("INVALIDATION_POLL_SECONDS", 1.0))  # Cache version polling when change streams are unavailable
+    LOCATIONS_STREAM_THRESHOLD = int(os.getenv("LOCATIONS_STREAM_THRESHOLD", 500))  # Wine count above which location lookups are streamed
+    MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))  # Connections opened per process ahead of traffic
+    CATALOG_READ_PREFERENCE = os.getenv("CATALOG_READ_PREFERENCE", "secondaryPreferred")  # Members serving catalog browsing
+    CATALOG_MAX_STALENESS_SECONDS = int(os.getenv("CATALOG_MAX_STALENESS_SECONDS", 90))  # At least 90, or -1 for no limit
+    CATALOG_SNAPSHOT_DIR = os.getenv("CATALOG_SNAPSHOT_DIR", "snapshots")  # Compressed catalog snapshots for offline clients
+    CATALOG_SNAPSHOT_SECONDS = int(os.getenv("CATALOG_SNAPSHOT_SECONDS", 3600))  # How often a changed catalog is snapshotted
+    CATALOG_CHANGES_RETENTION_DAYS = int(os.getenv("CATALOG_CHANGES_RETENTION_DAYS", 7))  # Older clients download a snapshot
+
+    # Production server (serve.py)
+    BIND = os.getenv("BIND", "0.0.0.0:8888")
+    WORKERS = int(os.getenv("WORKERS", multiprocessing.cpu_count() * 2 + 1))
+    THREADS = int(os.getenv("THREADS", 4))  # Threads per worker
+    KEEPALIVE = int(os.getenv("KEEPALIVE", 5))  # Seconds to keep idle client connections open
+    MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", 10000))  # Requests before a worker is recycled
+    MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", 1000))  # Spreads worker recycling over time
+    TIMEOUT = int(os.getenv("TIMEOUT", 30))
+    GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))  # Drain time for in-flight requests on SIGTERM/SIGHUP
@@ -0,0 +1,50 @@
+"""
+Backfill the normalized email of every account, used by signin lookups and the
+unique email index. Accounts whose emails collide once normalized are reported
+and left without email_norm, so they can be merged by hand.
+
+Run from the project root:
+    python -m migrations.backfill_account_emails
+"""
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from config import Config
+from routes.account_routes import normalize_email
+
+BATCH_SIZE = 1000
+
+#function to write a batch of normalized emails, returning the modified count and the colliding account ids
+def _write(accounts_collection, account_ids):
+    operations = [UpdateOne({"_id": account_id}, {"$set": {"email_norm": email_norm}}) for account_id, email_norm in account_ids]
+    try:
+        return accounts_collection.bulk_write(operations, ordered=False).modified_count, []
+    except BulkWriteError as e:
+        conflicts = [account_ids[error["index"]][0] for error in e.details["writeErrors"]]
+        return e.details["nModified"], conflicts
+
+#function to write the normalized email of every account in batched bulk writes
+def backfill_account_emails(accounts_collection):
+    operations = []
+    modified_count = 0
+    conflicts = []
+    for account in accounts_collection.find({"email": {"$type": "string"}}, {"email": 1, "email_norm": 1}):
+        email_norm = normalize_email(account["email"])
+        if account.get("email_norm") != email_norm:
+            operations.append((account["_id"], email_norm))
+        if len(operations) == BATCH_SIZE:
+            modified, failed = _write(accounts_collection, operations)
+            modified_count += modified
+            conflicts += failed
+            operations = []
+    if operations:
+        modified, failed = _write(accounts_collection, operations)
+        modified_count += modified
+        conflicts += failed
+    return modified_count, conflicts
+
+if __name__ == '__main__':
+    client = MongoClient(Config.MONGO_URI)
+    modified_count, conflicts = backfill_account_emails(client['wine_warehouse']['accounts'])
+    print(f"Backfilled normalized email of {modified_count} accounts")
+    for account_id in conflicts:
+        print(f"Account {account_id} has the email of another account")
@@ -0,0 +1,30 @@
+"""
+Backfill the derived fields of every wine document: the effective price and the
+normalized shadow fields of the categorical filters.
+
+Run from the project root:
+    python -m migrations.backfill_wine_fields
+"""
+from pymongo import MongoClient, UpdateOne
+from config import Config
+from routes.wine_fields import derived_wine_fields
+
+BATCH_SIZE = 1000
+
+#function to write the derived fields of every wine in batched bulk writes
+def backfill_wine_fields(wines_collection) -> int:
+    operations = []
+    modified_count = 0
+    for wine in wines_collection.find({}):
+        operations.append(UpdateOne({"_id": wine["_id"]}, {"$set": derived_wine_fields(wine)}))
+        if len(operations) == BATCH_SIZE:
+            modified_count += wines_collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        modified_count += wines_collection.bulk_write(operations, ordered=False).modified_count
+    return modified_count
+
+if __name__ == '__main__':
+    client = MongoClient(Config.MONGO_URI)
+    modified_count = backfill_wine_fields(client['wine_warehouse']['wines'])
+    print(f"Backfilled derived fields of {modified_count} wines")
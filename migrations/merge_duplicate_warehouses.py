@@ -0,0 +1,42 @@
+"""
+Merge warehouses sharing a location into the oldest one, so the unique location
+index can be built. The stock of every duplicate is added to the matching aisle,
+shelf and wine of the kept warehouse before the duplicate is deleted.
+
+Run from the project root, before starting the app:
+    python -m migrations.merge_duplicate_warehouses
+"""
+from pymongo import MongoClient
+from config import Config
+from routes.stock_manager import build_stock_intake_operations
+
+#function to merge every group of warehouses with the same location, returning the number deleted
+def merge_duplicate_warehouses(warehouses_collection) -> int:
+    duplicates = warehouses_collection.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$location", "warehouse_ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+
+    deleted_count = 0
+    for group in duplicates:
+        kept_id, duplicate_ids = group["warehouse_ids"][0], group["warehouse_ids"][1:]
+        for warehouse in warehouses_collection.find({"_id": {"$in": duplicate_ids}}):
+            slots = [
+                {"aisle": aisle.get("aisle"), "shelf": shelf.get("shelf"), "wine_id": wine.get("wine_id"), "stock": int(wine.get("stock", 0))}
+                for aisle in warehouse.get("aisles", [])
+                for shelf in aisle.get("shelves", [])
+                for wine in shelf.get("wines", [])
+            ]
+            operations = build_stock_intake_operations(kept_id, slots)
+            if operations:
+                warehouses_collection.bulk_write(operations, ordered=True)
+            deleted_count += warehouses_collection.delete_one({"_id": warehouse["_id"]}).deleted_count
+    return deleted_count
+
+if __name__ == '__main__':
+    client = MongoClient(Config.MONGO_URI)
+    warehouses_collection = client['wine_warehouse']['warehouses']
+    deleted_count = merge_duplicate_warehouses(warehouses_collection)
+    warehouses_collection.create_index("location", unique=True)
+    print(f"Merged {deleted_count} duplicate warehouses")
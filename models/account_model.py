@@ -0,0 +1,15 @@
+from typing import Any, Optional
+from pydantic import BaseModel, Field
+
+class Account(BaseModel):
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    email: str = Field(pattern=r"^[^@\s]+@[^@\s]+$")
+    password: str = Field(min_length=1)
+    phone: Optional[str] = None
+    status: Optional[Any] = None
+    address: Optional[Any] = None
+
+class Credentials(BaseModel):
+    email: str = Field(min_length=1)
+    password: str = Field(min_length=1)
@@ -1,17 +1,38 @@
-from bson import ObjectId
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Optional
+from .validation import ObjectIdStr
 
 class PurchaseItem(BaseModel):
-    wine_id: ObjectId
+    wine_id: ObjectIdStr
     quantity: int
 
 class Purchase(BaseModel):
-    user_id: ObjectId
+    user_id: ObjectIdStr
     items: List[PurchaseItem]
-    purchase_date: datetime = datetime.utcnow()
+    purchase_date: datetime = Field(default_factory=datetime.utcnow)
     address: Optional[str] = None
     city: Optional[str] = None
     province: Optional[str] = None
-    postal_code: Optional[str] = None
\ No newline at end of file
+    postal_code: Optional[str] = None
+
+class ReceiptLocation(BaseModel):
+    location: str = Field(min_length=1)
+    aisle: str
+    shelf: str
+    quantity: int = Field(gt=0)
+
+class PurchaseOrder(BaseModel):
+    wine_id: ObjectIdStr
+    cost_price: float = Field(ge=0)
+    amount: int = Field(gt=0)
+    locations: Optional[List[ReceiptLocation]] = None
+
+    @model_validator(mode="after")
+    def check_location_quantities(self):
+        if self.locations and sum(location.quantity for location in self.locations) != self.amount:
+            raise ValueError("location quantities must add up to the amount")
+        return self
+
+class PurchaseReceipt(PurchaseOrder):
+    purchase_id: Optional[ObjectIdStr] = None
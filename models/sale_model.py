@@ -0,0 +1,15 @@
+from typing import Any, Dict, List, Literal, Optional, Union
+from pydantic import BaseModel, Field
+from .validation import ObjectIdStr
+
+class SaleItem(BaseModel):
+    wine_id: ObjectIdStr
+    quantity: int = Field(gt=0)
+
+class SaleCart(BaseModel):
+    account_id: ObjectIdStr
+    items: List[SaleItem] = Field(min_length=1)
+    shipping_address: Optional[Union[str, Dict[str, Any]]] = None
+    cart_id: Optional[str] = None
+    # Names of ALLOCATION_STRATEGIES in routes/stock_manager.py; null uses the configured default
+    allocation_strategy: Optional[Literal["smallest_first", "fewest_slots", "single_warehouse", "nearest_warehouse"]] = None
@@ -0,0 +1,18 @@
+from typing import Optional
+from pydantic import BaseModel, Field
+from .validation import ObjectIdStr
+
+class Reservation(BaseModel):
+    cart_id: str = Field(min_length=1)
+    wine_id: ObjectIdStr
+    quantity: int = Field(gt=0)
+
+class ReservationReleaseQuery(BaseModel):
+    wine_id: Optional[ObjectIdStr] = None
+
+class ReplenishmentQuery(BaseModel):
+    window_days: int = Field(30, ge=1)
+    threshold: Optional[int] = None
+    days_of_cover: Optional[float] = Field(None, gt=0)
+    page: int = Field(1, ge=1)
+    limit: int = Field(50, ge=1, le=1000)
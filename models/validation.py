@@ -0,0 +1,71 @@
+from functools import wraps
+from typing import Annotated
+from bson.objectid import ObjectId
+from flask import g, jsonify, request
+from pydantic import AfterValidator, TypeAdapter, ValidationError
+
+#function to check that a string is a valid ObjectId
+def _check_object_id(value: str) -> str:
+    if not ObjectId.is_valid(value):
+        raise ValueError("must be a 24 character hex ObjectId")
+    return value
+
+#ObjectId received as a string, checked before it reaches ObjectId()
+ObjectIdStr = Annotated[str, AfterValidator(_check_object_id)]
+
+_object_id_adapter = TypeAdapter(ObjectIdStr)
+
+#function to build the 400 response of invalid input
+def validation_error_response(error: ValidationError):
+    return jsonify({
+        "message": "Invalid request data",
+        "errors": error.errors(include_url=False, include_context=False, include_input=False),
+        "response_status": False
+    }), 400
+
+#function to validate input with a schema compiled once, when the route is defined
+def _validate(schema, source, target):
+    adapter = TypeAdapter(schema)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                validated = adapter.validate_python(source())
+            except ValidationError as e:
+                return validation_error_response(e)
+            # Fields missing from the input are left out, so handlers keep using .get()
+            setattr(g, target, adapter.dump_python(validated, exclude_unset=True))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#decorator validating the JSON body of a request into g.body
+def validate_body(schema):
+    """
+    Validate the JSON body against a pydantic model, or any type such as List[Model] for
+    bulk endpoints, before the handler runs. The validated data is stored in g.body.
+    """
+    return _validate(schema, lambda: request.get_json(silent=True), "body")
+
+#decorator validating the query string of a request into g.query
+def validate_query(schema):
+    """
+    Validate the query string against a pydantic model before the handler runs.
+    The validated data is stored in g.query.
+    """
+    return _validate(schema, lambda: request.args.to_dict(), "query")
+
+#decorator validating ObjectId path parameters
+def validate_object_ids(*names):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            for name in names:
+                try:
+                    _object_id_adapter.validate_python(kwargs[name])
+                except ValidationError as e:
+                    return validation_error_response(e)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,35 @@
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
+from .validation import ObjectIdStr
+
+class WineStock(BaseModel):
+    wine_id: ObjectIdStr
+    stock: int
+
+class Shelf(BaseModel):
+    shelf: str
+    wines: List[WineStock] = Field(min_length=1)
+
+class Aisle(BaseModel):
+    aisle: str
+    shelves: List[Shelf] = Field(min_length=1)
+
+class Coordinates(BaseModel):
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+
+class WarehouseStock(BaseModel):
+    location: str = Field(min_length=1)
+    aisles: List[Aisle] = Field(min_length=1)
+    coordinates: Optional[Coordinates] = None  # Used by the nearest_warehouse allocation strategy
+
+class WineLocationsRequest(BaseModel):
+    wine_ids: List[ObjectIdStr] = Field(min_length=1)
+
+class WineLocationsQuery(BaseModel):
+    stream: bool = False  # Stream the locations as JSON lines, whatever the number of wines
+
+class InventoryQuery(BaseModel):
+    warehouse: Optional[str] = None  # Comma separated warehouse locations
+    type: Optional[str] = None  # Comma separated wine types
+    format: Literal["sparse", "dense"] = "sparse"
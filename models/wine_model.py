@@ -0,0 +1,91 @@
+from typing import Any, Dict, List, Optional, Union
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from .validation import ObjectIdStr
+
+class Wine(BaseModel):
+    image_path: Optional[str] = None
+    name: str = Field(min_length=1)
+    producer: Optional[str] = None
+    country: Optional[str] = None
+    harvest_year: Optional[int] = None
+    type: Optional[str] = None
+    rate: Optional[float] = Field(None, ge=0)
+    description: Optional[str] = None
+    reviews: Optional[Any] = None
+    grapes: Optional[List[str]] = None
+    taste_characteristics: Optional[Union[List[str], Dict[str, Any], str]] = None
+    food_pair: Optional[List[str]] = None
+    sale_price: Optional[float] = Field(None, ge=0)
+    discount: Optional[float] = Field(None, ge=0, le=1)
+    stock: Optional[int] = None
+
+class WinePatch(Wine):
+    # Only wine fields can be changed; derived fields are maintained by the server
+    model_config = ConfigDict(extra="forbid")
+
+    name: Optional[str] = Field(None, min_length=1)
+
+class Pagination(BaseModel):
+    page: int = Field(1, ge=1)
+    limit: int = Field(10, ge=1, le=1000)
+
+class WineFilter(BaseModel):
+    name: Optional[str] = None
+    type: Optional[str] = None
+    grape: Optional[str] = None
+    food_pair: Optional[str] = None
+    country: Optional[str] = None
+    producer: Optional[str] = None
+    min_harvest: Optional[int] = None
+    max_harvest: Optional[int] = None
+    discount: Optional[float] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+
+class WineFilterQuery(WineFilter, Pagination):
+    sort: Optional[str] = None
+    sort_price_order: Optional[str] = None
+
+class WineSearchQuery(Pagination):
+    q: str = ""
+
+class WineTypeQuery(BaseModel):
+    type: Optional[str] = None
+
+class SimilarWinesQuery(BaseModel):
+    k: int = Field(10, ge=1, le=100)
+
+class CatalogChangesQuery(BaseModel):
+    since: int = Field(ge=0)
+    limit: int = Field(1000, ge=1, le=10000)
+
+class WineIdList(BaseModel):
+    wine_ids: List[ObjectIdStr] = Field(min_length=1)
+
+class WineIncrement(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    sale_price: Optional[float] = None
+    discount: Optional[float] = None
+    rate: Optional[float] = None
+
+class WineBulkUpdate(BaseModel):
+    # Wines are selected by id or by the filters of GET /wines, and changed by set and/or inc
+    model_config = ConfigDict(extra="forbid")
+
+    wine_ids: Optional[List[ObjectIdStr]] = Field(None, min_length=1)
+    filter: Optional[WineFilter] = None
+    set: Optional[WinePatch] = None
+    inc: Optional[WineIncrement] = None
+
+    @model_validator(mode="after")
+    def check_selection_and_changes(self):
+        if (self.wine_ids is None) == (self.filter is None):
+            raise ValueError("exactly one of wine_ids or filter is required")
+        set_fields = self.set.model_fields_set if self.set else set()
+        inc_fields = self.inc.model_fields_set if self.inc else set()
+        if not set_fields and not inc_fields:
+            raise ValueError("set or inc must change at least one field")
+        if set_fields & inc_fields:
+            raise ValueError("a field can't be both set and incremented")
+        return self
@@ -1,50 +1,72 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, g, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
-from pymongo.errors import PyMongoError
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from bson.objectid import ObjectId
+from models.validation import validate_body, validate_query
+from models.account_model import Account, Credentials
 
 accounts_bp = Blueprint('account', __name__)
 
-def init_account_routes(accounts_collection):
+#account fields returned to the client
+ACCOUNT_PROJECTION = {"first_name": 1, "last_name": 1, "email": 1, "phone": 1, "status": 1, "type": 1, "address": 1}
+
+#flag document claimed by the first account, which becomes the admin
+ADMIN_BOOTSTRAP_FLAG = "admin_bootstrap"
+
+#function to normalize an email for lookups and the unique index
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+def init_account_routes(accounts_collection, account_flags_collection):
+    # Emails are unique once normalized; accounts missing email_norm are left to the backfill migration
+    accounts_collection.create_index(
+        "email_norm",
+        unique=True,
+        partialFilterExpression={"email_norm": {"$type": "string"}}
+    )
+
+    admin_bootstrapped = False  # Set once the flag is known to be claimed
+
     @accounts_bp.route('/account/signup', methods=['POST'])
+    @validate_body(Account)
     def signup():
-        data = request.get_json()
-    
-        # Check if this is the first account
-        if check_existing_accounts() == 0:
-            data["type"] = 1 # set as admin
-        elif get_account_by_email(data.get("email")):
+        nonlocal admin_bootstrapped
+        data = g.body
+
+        new_account = {
+            "first_name": data.get("first_name"),
+            "last_name": data.get("last_name"),
+            "email": data.get("email"),
+            "email_norm": normalize_email(data["email"]),
+            "password": generate_password_hash(data['password']),
+            "phone": data.get("phone"),
+            "status": data.get("status"),
+            "type": None,  # Account types are granted by the server, never taken from the client
+            "address": data.get("address")
+        }
+        # The unique index rejects concurrent signups with the same email
+        try:
+            result = accounts_collection.insert_one(new_account)
+        except DuplicateKeyError:
             return jsonify({
                 "message": "User already exists",
                 "response_status": False
             }), 400
-    
-        # Function to create an account
-        def create_account(data):
-            hashed_password = generate_password_hash(data['password'])
-            new_account = {
-                "first_name": data.get("first_name"),
-                "last_name": data.get("last_name"),
-                "email": data.get("email"),
-                "password": hashed_password,
-                "phone": data.get("phone"),
-                "status": data.get("status"),
-                "type": data.get("type"),
-                "address": data.get("address")
-            }
-            try:
-                result = accounts_collection.insert_one(new_account)
-                new_account["_id"] = str(result.inserted_id)
-                return new_account
-            except Exception as e:
-                return None, str(e)
-        
-        account = create_account(data)
-        if not account:
+        except PyMongoError:
             return jsonify({
                 "message": "Error creating account",
                 "response_status": False
             }), 500
+
+        # Only the signup that claims the flag becomes the admin
+        if not admin_bootstrapped:
+            if claim_admin_bootstrap(result.inserted_id):
+                accounts_collection.update_one({"_id": result.inserted_id}, {"$set": {"type": 1}})
+                new_account["type"] = 1  # set as admin
+            admin_bootstrapped = True
+
+        account = {field: new_account[field] for field in ACCOUNT_PROJECTION}
+        account["_id"] = str(result.inserted_id)
         
         # Prepare response with account data
         response = {
@@ -56,12 +78,13 @@ def init_account_routes(accounts_collection):
 
     
     @accounts_bp.route('/account/signin', methods=['POST'])
+    @validate_body(Credentials)
     def signin():
-        data = request.get_json()
-        account = get_account_by_email(data["email"])
+        data = g.body
+        account = get_account_by_email(data["email"], {**ACCOUNT_PROJECTION, "password": 1})
         
         if account:
-            if verify_password(account["password"], data["password"]):
+            if verify_password(account.pop("password"), data["password"]):
                 # Prepare response
                 response = {
                     "message": "Account successfully Authenticated and validated",
@@ -85,21 +108,15 @@ def init_account_routes(accounts_collection):
         
 
     @accounts_bp.route('/account/delete', methods=['DELETE'])
+    @validate_query(Credentials)
     def delete_account():
         
         # Extract email and password from query parameters
-        email = request.args.get('email')
-        password = request.args.get('password')
-    
-        # Validate input
-        if not email or not password:
-            return jsonify({
-                "message": "Invalid request data",
-                "response_status": False
-            }), 400
+        email = g.query['email']
+        password = g.query['password']
         
         # Retrieve account
-        account = get_account_by_email(email)
+        account = get_account_by_email(email, {"password": 1})
         if account:
             # Verify password
             if verify_password(account["password"], password):
@@ -126,8 +143,8 @@ def init_account_routes(accounts_collection):
             "response_status": False
         }), 404
 
-    def get_account_by_email(email):
-        account = accounts_collection.find_one({"email": email})
+    def get_account_by_email(email, projection):
+        account = accounts_collection.find_one({"email_norm": normalize_email(email)}, projection)
         if account:
             # Convert _id to string to make it JSON serializable
             account["_id"] = str(account["_id"])
@@ -135,6 +152,16 @@ def init_account_routes(accounts_collection):
     
     def verify_password(stored_password, provided_password):
         return check_password_hash(stored_password, provided_password)
-        
-    def check_existing_accounts():
-        return accounts_collection.count_documents({})
+
+    #function to claim the one-time admin bootstrap, True only for the first caller
+    def claim_admin_bootstrap(account_id):
+        try:
+            account_flags_collection.insert_one({"_id": ADMIN_BOOTSTRAP_FLAG, "account_id": account_id})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    # Accounts created before the flag existed already have their admin
+    if accounts_collection.find_one({}, {"_id": 1}):
+        claim_admin_bootstrap(None)
+        admin_bootstrapped = True
@@ -0,0 +1,240 @@
+import atexit
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from .stock_manager import get_total_stock_for_wines
+
+logger = logging.getLogger(__name__)
+
+#kinds of catalog changes: a wine document or the stock of a wine changed, or the whole catalog was replaced
+WINE_CHANGE = "wine"
+STOCK_CHANGE = "stock"
+RESET_CHANGE = "reset"
+
+#wine fields computed by the server for its own filters, left out of synced wines
+SYNC_PROJECTION = {"type_norm": 0, "country_norm": 0, "grapes_norm": 0, "food_pair_norm": 0}
+
+
+class CatalogChangeLog:
+    """
+    Append-only log of catalog changes, numbered by a global sequence, so clients
+    holding a copy of the catalog can fetch only what changed since their version.
+    Entries are recorded after the write they describe, and removed after the retention period.
+    Changes on hot paths, like stock after every sale, are queued with record_later and
+    written by a background thread, merged per kind, every flush_interval.
+    """
+
+    def __init__(self, changes_collection, versions_collection, retention_days: int = 7, gap_seconds: float = 5.0,
+                 flush_interval: float = 0.5):
+        self.changes_collection = changes_collection
+        self.versions_collection = versions_collection
+        self.retention_days = retention_days
+        self.gap_seconds = gap_seconds
+        self.flush_interval = flush_interval
+
+        self._pending = {}  # kind -> wine_ids waiting to be recorded, None for a reset
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def create_indexes(self):
+        self.changes_collection.create_index("recorded_at", expireAfterSeconds=self.retention_days * 24 * 3600)
+
+    #function to record that wines or their stock changed, or that the catalog was replaced (wine_ids None)
+    def record(self, kind: str, wine_ids=None):
+        if wine_ids is None:
+            kind, wine_ids = RESET_CHANGE, [None]
+        wine_ids = list(dict.fromkeys(str(wine_id) if wine_id is not None else None for wine_id in wine_ids))
+        if not wine_ids:
+            return
+        try:
+            # Reserve one sequence number per wine in a single round trip
+            last = self.versions_collection.find_one_and_update(
+                {"_id": "catalog"},
+                {"$inc": {"seq": len(wine_ids)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )["seq"]
+            first = last - len(wine_ids) + 1
+            recorded_at = datetime.utcnow()
+            self.changes_collection.insert_many([
+                {"_id": first + offset, "kind": kind, "wine_id": wine_id, "recorded_at": recorded_at}
+                for offset, wine_id in enumerate(wine_ids)
+            ])
+            if kind == RESET_CHANGE:
+                self.versions_collection.update_one({"_id": "catalog"}, {"$max": {"reset_seq": last}})
+        except PyMongoError:
+            logger.exception("Failed to record %s changes of %d wines", kind, len(wine_ids))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="catalog-changes", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    #function to queue changes for the background writer, keeping their database writes off the request path
+    def record_later(self, kind: str, wine_ids=None):
+        with self._condition:
+            if wine_ids is None:
+                self._pending[RESET_CHANGE] = None
+            else:
+                self._pending.setdefault(kind, {}).update(dict.fromkeys(wine_ids))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopping:
+                    self._condition.wait(self.flush_interval)
+                pending, self._pending = self._pending, {}
+                stopping = self._stopping
+
+            # Resets go last, so they cover the changes recorded with them
+            for kind, wine_ids in sorted(pending.items(), key=lambda item: item[0] == RESET_CHANGE):
+                self.record(kind, list(wine_ids) if wine_ids is not None else None)
+            if stopping:
+                return
+
+    #function to record the queued changes and stop the background writer
+    def close(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    #function to return the sequence number of the latest change and of the latest reset
+    def versions(self) -> tuple:
+        document = self.versions_collection.find_one({"_id": "catalog"}) or {}
+        return document.get("seq", 0), document.get("reset_seq", 0)
+
+    #function to read the changes following a version
+    def changes_since(self, since: int, limit: int) -> dict:
+        """
+        Read the changes recorded after a version, merged per wine.
+        Sequence numbers are reserved before their entry is written, so a missing number
+        may still be on its way; reading stops there until it lands or is given up on.
+        :param since: The version the client holds.
+        :param limit: Maximum number of entries to read.
+        :return: Dictionary with the new version, the changed wine_ids by kind and has_more,
+                 or with expired set when the client must download a snapshot instead.
+        """
+        current, reset = self.versions()
+        oldest = self.changes_collection.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+        horizon = oldest["_id"] - 1 if oldest else current
+        if since > current or since < horizon or since < reset:
+            return {"expired": True, "version": current}
+
+        entries = list(self.changes_collection.find({"_id": {"$gt": since}}).sort("_id", 1).limit(limit))
+        gap_deadline = datetime.utcnow() - timedelta(seconds=self.gap_seconds)
+        version = since
+        changed = {WINE_CHANGE: set(), STOCK_CHANGE: set()}
+        for entry in entries:
+            if entry["_id"] != version + 1 and entry["recorded_at"] > gap_deadline:
+                break  # An earlier change is still being recorded
+            if entry["kind"] == RESET_CHANGE:
+                return {"expired": True, "version": current}
+            changed[entry["kind"]].add(entry["wine_id"])
+            version = entry["_id"]
+
+        return {
+            "expired": False,
+            "version": version,
+            "wine_ids": changed[WINE_CHANGE],
+            "stock_ids": changed[STOCK_CHANGE],
+            "has_more": version < current
+        }
+
+
+class CatalogSnapshot:
+    """
+    Gzipped JSON file holding the whole catalog with the total stock of every wine,
+    tagged with the change log version it was read at. It is rebuilt in the background
+    when the catalog changed; processes sharing the directory build it one at a time
+    under a flock and all serve the newest file.
+    """
+
+    def __init__(self, wines_collection, warehouses_collection, change_log, snapshot_dir: str, interval: float = 3600):
+        self.wines_collection = wines_collection
+        self.warehouses_collection = warehouses_collection
+        self.change_log = change_log
+        self.snapshot_dir = os.path.abspath(snapshot_dir)  # send_file resolves relative paths against the app
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="catalog-snapshot", daemon=True)
+        self._thread.start()
+
+    #function to return the version and path of the newest snapshot, or (0, None)
+    def latest(self) -> tuple:
+        paths = sorted(glob.glob(os.path.join(self.snapshot_dir, "catalog-*.json.gz")))
+        if not paths:
+            return 0, None
+        path = paths[-1]
+        return int(os.path.basename(path)[len("catalog-"):-len(".json.gz")]), path
+
+    #function to return the newest snapshot, building it first when it's older than min_version
+    def ensure_current(self, min_version: int = 0) -> tuple:
+        version, path = self.latest()
+        if path is None or version < min_version:
+            self.rebuild(wait=True)
+            version, path = self.latest()
+        return version, path
+
+    #function to write a new snapshot of the catalog
+    def rebuild(self, wait: bool = False):
+        """
+        Read the catalog and its stock and write them to a new snapshot file.
+        The version is read before the data, and changes are recorded after their write,
+        so the snapshot holds at least every change up to its version.
+        :param wait: Wait for a rebuild running in another process instead of skipping.
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with open(os.path.join(self.snapshot_dir, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another process is building it
+
+            version, _ = self.change_log.versions()
+            latest_version, latest_path = self.latest()
+            if latest_path is not None and latest_version >= version:
+                return  # Built meanwhile
+
+            wines = list(self.wines_collection.find({}, SYNC_PROJECTION))
+            # Total stock: holds expire through the TTL index without a recorded change, so they aren't synced
+            stock = get_total_stock_for_wines(self.warehouses_collection)
+            for wine in wines:
+                wine["_id"] = str(wine["_id"])
+                wine["stock"] = stock.get(wine["_id"], 0)
+
+            path = os.path.join(self.snapshot_dir, f"catalog-{version:012d}.json.gz")
+            with gzip.open(path + ".tmp", "wt", encoding="utf-8") as snapshot:
+                json.dump({"version": version, "wines": wines}, snapshot, separators=(",", ":"), default=str)
+            os.replace(path + ".tmp", path)
+
+            # Keep the previous snapshot for clients still downloading it
+            for old_path in sorted(glob.glob(os.path.join(self.snapshot_dir, "catalog-*.json.gz")))[:-2]:
+                os.remove(old_path)
+        logger.info("Wrote catalog snapshot %d with %d wines", version, len(wines))
+
+    def _run(self):
+        while True:
+            try:
+                version, _ = self.change_log.versions()
+                latest_version, latest_path = self.latest()
+                if latest_path is None or latest_version < version:
+                    self.rebuild()
+            except Exception:
+                logger.exception("Failed to rebuild the catalog snapshot")
+            time.sleep(self.interval)
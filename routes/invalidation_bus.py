@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+#change stream operations that tell which document changed
+DOCUMENT_OPERATIONS = {"insert", "update", "replace", "delete"}
+
+
+class InvalidationBus:
+    """
+    Delivers invalidation events for writes made by any process to the subscribers of this process.
+    Events come from a change stream on the watched collections. When change streams
+    aren't available (standalone server, or a local stand-in without watch), writers bump a version document
+    per collection and every process polls those versions instead.
+    Events arriving within batch_window are coalesced into one call per collection, and
+    events for writes this process published itself are skipped, as it already applied them.
+    Subscribers are called with the changed document ids as strings,
+    or None when the changed documents are unknown.
+    """
+
+    def __init__(self, db, collection_names: list, versions_collection, poll_interval: float = 1.0,
+                 batch_window: float = 0.2, max_batch: int = 1000, own_write_ttl: float = 10.0):
+        self.db = db
+        self.collection_names = list(collection_names)
+        self.versions_collection = versions_collection
+        self.poll_interval = poll_interval
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.own_write_ttl = own_write_ttl
+        self._subscribers = {name: [] for name in self.collection_names}
+        self._change_streams = None  # Unknown until the worker starts watching
+        self._own_writes = {}  # (collection, document id) -> (events still expected, expiry)
+        self._own_writes_lock = threading.Lock()
+        self._thread = None
+
+    #function to register a callback for the changes of a collection
+    def subscribe(self, collection_name: str, callback):
+        self._subscribers[collection_name].append(callback)
+
+    #function to announce a write of this process to the other processes
+    def publish(self, collection_name: str, document_ids=None):
+        # Change streams already carry every write; polling processes need the version bumped
+        if self._change_streams:
+            self._remember_own_writes(collection_name, document_ids)
+            return
+        try:
+            self.versions_collection.update_one({"_id": collection_name}, {"$inc": {"version": 1}}, upsert=True)
+        except PyMongoError:
+            logger.exception("Failed to publish invalidation of %s", collection_name)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="invalidation-bus", daemon=True)
+        self._thread.start()
+
+    #function to remember documents written by this process, so their change events are skipped
+    def _remember_own_writes(self, collection_name: str, document_ids):
+        if not document_ids:
+            return
+        expiry = time.monotonic() + self.own_write_ttl
+        with self._own_writes_lock:
+            for document_id in document_ids:
+                key = (collection_name, str(document_id))
+                count, _ = self._own_writes.get(key, (0, None))
+                self._own_writes[key] = (count + 1, expiry)
+
+    #function to tell whether a change event is the echo of a write of this process, consuming it
+    def _is_own_write(self, collection_name: str, document_id: str) -> bool:
+        key = (collection_name, document_id)
+        with self._own_writes_lock:
+            count, expiry = self._own_writes.get(key, (0, None))
+            if not count or expiry < time.monotonic():
+                self._own_writes.pop(key, None)
+                return False
+            if count > 1:
+                self._own_writes[key] = (count - 1, expiry)
+            else:
+                del self._own_writes[key]
+            return True
+
+    #function to forget writes whose change events never came, e.g. updates that changed nothing
+    def _expire_own_writes(self):
+        now = time.monotonic()
+        with self._own_writes_lock:
+            for key in [key for key, (_, expiry) in self._own_writes.items() if expiry < now]:
+                del self._own_writes[key]
+
+    def _notify(self, collection_name: str, document_ids):
+        for callback in self._subscribers.get(collection_name, []):
+            try:
+                callback(document_ids)
+            except Exception:
+                logger.exception("Invalidation subscriber of %s failed", collection_name)
+
+    def _run(self):
+        try:
+            self._watch()
+        except Exception as e:
+            # Only the first watch can fail this way; later failures are resumed in _watch
+            logger.info("Change streams unavailable (%s), polling cache versions", e)
+            self._change_streams = False
+            self._poll()
+
+    def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": self.collection_names}}}]
+        resume_token = None
+        while True:
+            try:
+                with self.db.watch(pipeline, resume_after=resume_token,
+                                   max_await_time_ms=max(int(self.batch_window * 1000), 1)) as stream:
+                    self._change_streams = True
+                    pending = {}  # collection -> set of changed ids, or None when unknown
+                    pending_count = 0
+                    batch_started = None
+                    while stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            collection_name = change["ns"]["coll"]
+                            if change["operationType"] not in DOCUMENT_OPERATIONS:
+                                pending[collection_name] = None  # drop, rename, invalidate...
+                            else:
+                                document_id = str(change["documentKey"]["_id"])
+                                if not self._is_own_write(collection_name, document_id):
+                                    if pending.setdefault(collection_name, set()) is not None:
+                                        pending[collection_name].add(document_id)
+                            pending_count += 1
+                            batch_started = batch_started or time.monotonic()
+
+                        # Deliver once the stream is idle, the window is over or the batch is full
+                        if batch_started is not None and (change is None or pending_count >= self.max_batch
+                                                          or time.monotonic() - batch_started >= self.batch_window):
+                            for collection_name, document_ids in pending.items():
+                                self._notify(collection_name, sorted(document_ids) if document_ids is not None else None)
+                            resume_token = stream.resume_token
+                            pending, pending_count, batch_started = {}, 0, None
+                        elif change is None:
+                            resume_token = stream.resume_token
+                            self._expire_own_writes()
+            except PyMongoError as e:
+                if self._change_streams is None:
+                    raise  # Change streams aren't supported
+                logger.exception("Change stream interrupted, resuming")
+                if isinstance(e, OperationFailure):
+                    resume_token = None  # The token may be unusable, e.g. history lost
+
+            # Anything may have changed while the stream was down
+            for collection_name in self.collection_names:
+                self._notify(collection_name, None)
+            time.sleep(self.poll_interval)
+
+    def _poll(self):
+        versions = {}
+        while True:
+            try:
+                current = {document["_id"]: document["version"] for document in self.versions_collection.find({"_id": {"$in": self.collection_names}})}
+                for collection_name in self.collection_names:
+                    if collection_name in versions and current.get(collection_name) != versions[collection_name]:
+                        self._notify(collection_name, None)
+                versions = {name: current.get(name) for name in self.collection_names}
+            except PyMongoError:
+                logger.exception("Failed to poll cache versions")
+            time.sleep(self.poll_interval)
@@ -0,0 +1,239 @@
+import atexit
+import fcntl
+import glob
+import logging
+import os
+import threading
+import uuid
+from bson import json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+#function to insert invoices, ignoring the ones already stored by a previous attempt
+def insert_invoices(sales_collection, invoices: list):
+    """
+    Insert a batch of invoices with insert_many. Invoices carry a client-side _id,
+    so duplicate key errors mean the invoice was already stored and are ignored.
+    :param sales_collection: The MongoDB collection for sales.
+    :param invoices: List of invoice documents.
+    """
+    try:
+        sales_collection.insert_many(invoices, ordered=False)
+    except BulkWriteError as e:
+        errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY_ERROR]
+        if errors or e.details.get("writeConcernErrors"):
+            raise
+
+
+class InvoiceWriter:
+    """
+    Write-behind queue for invoices.
+    Each invoice is appended to an on-disk journal before enqueue returns, and a
+    background worker stores the queued invoices with batched insert_many calls.
+    Every process writes to journal files locked with flock, starting a new one for
+    each batch it stores and removing the old one once all its invoices are stored;
+    journals left behind by dead processes are replayed on start. Invoices the database
+    keeps rejecting are moved to a dead-letter file instead of blocking the queue.
+    """
+
+    def __init__(self, sales_collection, journal_dir: str, batch_size: int = 100,
+                 flush_interval: float = 0.5, fsync: bool = True, max_attempts: int = 5):
+        self.sales_collection = sales_collection
+        self.journal_dir = journal_dir
+        self.dead_letter_path = os.path.join(journal_dir, "dead-letter.jsonl")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_attempts = max_attempts
+        self.handlers = []  # Called with every stored batch, e.g. for rollups or emails
+
+        self._queue = []  # (journal, invoice) pairs
+        self._condition = threading.Condition()
+        self._journal = None
+        self._stopping = False
+        self._thread = None
+
+    #function to register a callback run by the worker after each stored batch
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def start(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.replay()
+        self._journal = self._open_journal()
+
+        self._thread = threading.Thread(target=self._run, name="invoice-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    #function to open a new journal file of this process, locked until its invoices are stored
+    def _open_journal(self) -> dict:
+        path = os.path.join(self.journal_dir, f"invoices-{os.getpid()}-{uuid.uuid4().hex}.jsonl")
+
+        # Locked under a name replay doesn't match, so it never sees the file unlocked
+        journal = open(path + ".new", "a", encoding="utf-8")
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(path + ".new", path)
+        return {"path": path, "file": journal, "pending": 0}
+
+    #function to remove a journal whose invoices are all stored
+    def _remove_journal(self, journal: dict):
+        os.remove(journal["path"])  # Removed before unlocking, so no other process replays it
+        journal["file"].close()
+
+    #function to store the invoices of journals left behind by dead processes
+    def replay(self) -> int:
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, "invoices-*.jsonl"))):
+            try:
+                journal = open(path, "r+", encoding="utf-8")
+            except FileNotFoundError:
+                continue  # Replayed by another process meanwhile
+
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # Journal of a live process
+                if os.fstat(journal.fileno()).st_nlink == 0:
+                    continue  # Replayed and removed by another process while we opened it
+
+                invoices = []
+                for line in journal:
+                    try:
+                        invoices.append(json_util.loads(line))
+                    except ValueError:
+                        logger.warning("Skipping incomplete journal entry in %s", path)
+
+                for start in range(0, len(invoices), self.batch_size):
+                    batch = invoices[start:start + self.batch_size]
+                    try:
+                        insert_invoices(self.sales_collection, batch)
+                    except BulkWriteError as e:
+                        # Already retried by the process that journaled them
+                        rejected = self._rejected(batch, e)
+                        if not rejected:
+                            raise
+                        self._dead_letter([batch[index] for index in rejected])
+                replayed += len(invoices)
+                os.remove(path)
+
+        if replayed:
+            logger.info("Replayed %d journaled invoices", replayed)
+        return replayed
+
+    #function to return the positions of the invoices in a batch the database rejected
+    def _rejected(self, batch: list, error) -> set:
+        if not isinstance(error, BulkWriteError) or error.details.get("writeConcernErrors"):
+            return set()  # Transient, or the stored invoices may not be durable yet
+        return {
+            write_error["index"] for write_error in error.details.get("writeErrors", [])
+            if write_error.get("code") != DUPLICATE_KEY_ERROR
+        }
+
+    #function to set invoices the database rejects aside for manual review
+    def _dead_letter(self, invoices: list):
+        with open(self.dead_letter_path, "a", encoding="utf-8") as dead_letter:
+            fcntl.flock(dead_letter, fcntl.LOCK_EX)  # Shared by every process
+            for invoice in invoices:
+                dead_letter.write(json_util.dumps(invoice) + "\n")
+            dead_letter.flush()
+            os.fsync(dead_letter.fileno())
+        logger.error("Moved %d rejected invoices to %s", len(invoices), self.dead_letter_path)
+
+    #function to journal an invoice and queue it for storage
+    def enqueue(self, invoice: dict):
+        line = json_util.dumps(invoice)
+        with self._condition:
+            journal = self._journal
+            journal["file"].write(line + "\n")
+            journal["file"].flush()
+            if self.fsync:
+                os.fsync(journal["file"].fileno())
+            journal["pending"] += 1
+
+            # Queue a copy, so the caller can keep using its document
+            self._queue.append((journal, json_util.loads(line)))
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify()
+
+    def _run(self):
+        attempts = 0
+        while True:
+            with self._condition:
+                if not self._queue and not self._stopping:
+                    self._condition.wait(self.flush_interval)
+                if not self._queue:
+                    if self._stopping:
+                        return
+                    continue
+                entries = self._queue[:self.batch_size]
+
+                # Invoices journaled from now on go to a new file, so the batch's files can be removed once it's stored
+                if entries[-1][0] is self._journal and not self._stopping:
+                    try:
+                        self._journal = self._open_journal()
+                    except OSError:
+                        logger.exception("Failed to open a new invoice journal, appending to %s", self._journal["path"])
+            batch = [invoice for _, invoice in entries]
+
+            try:
+                insert_invoices(self.sales_collection, batch)
+                rejected = set()
+            except PyMongoError as e:
+                attempts += 1
+                rejected = self._rejected(batch, e) if attempts >= self.max_attempts else set()
+                try:
+                    if rejected:
+                        self._dead_letter([batch[index] for index in sorted(rejected)])
+                except OSError:
+                    logger.exception("Failed to write the invoice dead-letter file")
+                    rejected = set()
+                if not rejected:
+                    logger.exception("Failed to store %d invoices (attempt %d), retrying", len(batch), attempts)
+                    with self._condition:
+                        if self._stopping:
+                            return  # The journal keeps them for the next start
+                        self._condition.wait(self.flush_interval)
+                    continue
+            attempts = 0
+
+            with self._condition:
+                del self._queue[:len(entries)]
+                for journal, _ in entries:
+                    journal["pending"] -= 1
+
+                # Remove the journals whose invoices are all stored
+                for journal in {id(journal): journal for journal, _ in entries}.values():
+                    if not journal["pending"] and journal is not self._journal:
+                        self._remove_journal(journal)
+
+            stored = [invoice for index, invoice in enumerate(batch) if index not in rejected]
+            for handler in self.handlers:
+                try:
+                    handler(stored)
+                except Exception:
+                    logger.exception("Invoice handler %r failed", handler)
+
+    #function to store the queued invoices and stop the worker
+    def close(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+        # Journals still holding queued invoices are kept for the next start
+        with self._condition:
+            journals = {id(journal): journal for journal, _ in self._queue}
+            journals.setdefault(id(self._journal), self._journal)
+            for journal in journals.values():
+                if journal["pending"]:
+                    journal["file"].close()
+                else:
+                    self._remove_journal(journal)
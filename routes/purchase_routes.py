@@ -1,16 +1,22 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, g, jsonify
 from pymongo.errors import PyMongoError
+from pymongo import UpdateOne
 from bson.objectid import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
+from .stock_manager import apply_stock_intakes, get_warehouse_id, notify_stock_change, start_stock_session
+from models.validation import validate_body
+from models.purchase_model import PurchaseOrder, PurchaseReceipt
+from typing import List, Union
 
 purchases_bp = Blueprint('purchases', __name__)
 
-def init_purchase_routes(purchases_collection):
+def init_purchase_routes(purchases_collection, warehouses_collection, receipt_claim_timeout=300):
     
     #Place purchase order (Expanding stock).
     @purchases_bp.route('/purchase', methods=['POST'])
+    @validate_body(PurchaseOrder)
     def place_purchase_order():
-        data = request.get_json()
+        data = g.body
         
         # Function to create a purchase order
         def create_purchase_order(data):
@@ -18,7 +24,9 @@ def init_purchase_routes(purchases_collection):
                 "wine_id": data.get("wine_id"),
                 "cost_price": data.get("cost_price"),
                 "amount": data.get("amount"),
-                "date": datetime.utcnow()  # Server timestamp
+                "date": datetime.utcnow(),  # Server timestamp
+                "locations": data.get("locations"),  # Target locations for receiving
+                "receipt_status": "pending"
             }
             try:
                 result = purchases_collection.insert_one(new_order)
@@ -43,14 +51,9 @@ def init_purchase_routes(purchases_collection):
         
     # Create initial list of stock
     @purchases_bp.route('/purchase/all', methods=['POST'])
+    @validate_body(List[PurchaseOrder])
     def create_initial_purchase():
-        data_list = request.json
-        
-        if not isinstance(data_list, list):
-            return jsonify({
-                "message": "Input data must be a list",
-                "response_status": False
-            }), 400
+        data_list = g.body
 
         def create_order_list():
             order_list = []
@@ -59,7 +62,9 @@ def init_purchase_routes(purchases_collection):
                     "wine_id": data.get("wine_id"),
                     "cost_price": data.get("cost_price"),
                     "amount": data.get("amount"),
-                    "date": datetime.utcnow()  # Server timestamp
+                    "date": datetime.utcnow(),  # Server timestamp
+                    "locations": data.get("locations"),  # Target locations for receiving
+                    "receipt_status": "pending"
                 }
                 order_list.append(new_order)
                 
@@ -82,3 +87,144 @@ def init_purchase_routes(purchases_collection):
             "response_status": True
         }
         return jsonify(response), 201
+        
+    # Receive purchase orders into their target warehouse locations
+    @purchases_bp.route('/purchase/receive', methods=['POST'])
+    @validate_body(Union[PurchaseReceipt, List[PurchaseReceipt]])
+    def receive_purchase_orders():
+        data_list = g.body
+        if isinstance(data_list, dict):
+            data_list = [data_list]
+            
+        # Orders already recorded must be received with their own wine and amount,
+        # as the locations are checked against the amount of the payload
+        requested_ids = [ObjectId(data["purchase_id"]) for data in data_list if data.get("purchase_id")]
+        stored = {purchase["_id"]: purchase for purchase in purchases_collection.find(
+            {"_id": {"$in": requested_ids}}, {"wine_id": 1, "amount": 1}
+        )}
+        mismatched = []
+        for data in data_list:
+            purchase = stored.get(ObjectId(data["purchase_id"])) if data.get("purchase_id") else None
+            if purchase and (str(purchase.get("wine_id")) != data["wine_id"] or purchase.get("amount") != data["amount"]):
+                mismatched.append(data["purchase_id"])
+        if mismatched:
+            return jsonify({
+                "message": "Wine or amount differs from the recorded purchase order",
+                "purchase_ids": mismatched,
+                "response_status": False
+            }), 409
+
+        # Register the orders, keeping the ones already recorded by their purchase_id
+        now = datetime.utcnow()
+        purchase_ids = []
+        operations = []
+        for data in data_list:
+            purchase_id = ObjectId(data["purchase_id"]) if data.get("purchase_id") else ObjectId()
+            purchase_ids.append(purchase_id)
+            locations = data.get("locations")
+
+            operations.append(UpdateOne(
+                {"_id": purchase_id},
+                {"$setOnInsert": {
+                    "wine_id": data.get("wine_id"),
+                    "cost_price": data.get("cost_price"),
+                    "amount": data.get("amount"),
+                    "date": now,  # Server timestamp
+                    "receipt_status": "pending"
+                }},
+                upsert=True
+            ))
+            if locations:
+                operations.append(UpdateOne(
+                    {
+                        "_id": purchase_id,
+                        "wine_id": data.get("wine_id"),
+                        "amount": data.get("amount"),  # Only locations adding up to the stored amount
+                        "receipt_status": {"$nin": ["receiving", "received"]}
+                    },
+                    {"$set": {"locations": locations}}
+                ))
+        purchases_collection.bulk_write(operations, ordered=True)
+        
+        # Claim the orders not received yet; a retry finds them claimed or received and skips them,
+        # unless the claim is older than the timeout, i.e. its request died before finishing
+        receipt_token = ObjectId()
+        purchases_collection.update_many(
+            {
+                "_id": {"$in": purchase_ids},
+                "locations.0": {"$exists": True},
+                "$or": [
+                    {"receipt_status": {"$nin": ["receiving", "received"]}},
+                    {"receipt_status": "receiving", "receipt_started": {"$lt": now - timedelta(seconds=receipt_claim_timeout)}}
+                ]
+            },
+            {"$set": {"receipt_status": "receiving", "receipt_token": receipt_token, "receipt_started": now}}
+        )
+        claimed = list(purchases_collection.find({"receipt_token": receipt_token}, {"wine_id": 1, "locations": 1}))
+        
+        # Apply the stock of every claimed order with one bulk write
+        slots_by_warehouse = {}
+        for purchase in claimed:
+            for location in purchase["locations"]:
+                warehouse_id = get_warehouse_id(warehouses_collection, location.get("location"))
+                slots_by_warehouse.setdefault(warehouse_id, []).append({
+                    "aisle": location.get("aisle"),
+                    "shelf": location.get("shelf"),
+                    "wine_id": str(purchase["wine_id"]),
+                    "stock": int(location.get("quantity"))
+                })
+        
+        # Mark the orders received and add their stock in one transaction, so a receipt is applied once or not at all
+        def receive_claimed(session):
+            marked = purchases_collection.update_many(
+                {"receipt_token": receipt_token, "receipt_status": "receiving"},
+                {"$set": {"receipt_status": "received", "received_at": datetime.utcnow()}},
+                session=session
+            )
+            if marked.modified_count != len(claimed):
+                # A stale claim was taken over by a retry, which will receive the orders
+                session.abort_transaction()
+                return {"success": False, "message": "Receipt taken over by another request."}
+            result = apply_stock_intakes(warehouses_collection, slots_by_warehouse, session=session, notify=False)
+            if not result["success"]:
+                session.abort_transaction()
+            return result
+
+        if claimed:
+            try:
+                with start_stock_session(purchases_collection) as session:
+                    result = session.with_transaction(receive_claimed)
+            except Exception as e:
+                result = {"success": False, "message": str(e)}
+
+            if not result["success"]:
+                purchases_collection.update_many(
+                    {"receipt_token": receipt_token, "receipt_status": "receiving"},
+                    {"$set": {"receipt_status": "failed"}, "$unset": {"receipt_token": ""}}
+                )
+                return jsonify({
+                    "message": "Error adding stock",
+                    "response_status": False
+                }), 500
+            notify_stock_change(list({slot["wine_id"] for slots in slots_by_warehouse.values() for slot in slots}))
+            
+        # Report the receipt status of every order
+        statuses = {purchase["_id"]: purchase for purchase in purchases_collection.find(
+            {"_id": {"$in": purchase_ids}}, {"receipt_status": 1}
+        )}
+        received_now = {purchase["_id"] for purchase in claimed}
+        orders = []
+        for purchase_id in purchase_ids:
+            status = statuses[purchase_id].get("receipt_status")
+            if status == "received" and purchase_id not in received_now:
+                status = "already_received"
+            elif status not in ("received", "receiving"):
+                status = "missing_locations"
+            orders.append({"purchase_id": str(purchase_id), "receipt_status": status})
+
+        return jsonify({
+            "message": "Purchase orders processed",
+            "received": len(claimed),
+            "orders": orders,
+            "response_status": True
+        }), 200
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    LRU cache of serialized query results, bounded by the total size of the results.
+    Every entry is tagged with the versions of the data it was computed from (e.g. the
+    catalog and the stock). Bumping a version invalidates only the entries tagged with it.
+    With max_age, entries also expire, which bounds how long a result read from a
+    lagging secondary can be served after the write that made it stale.
+    """
+
+    def __init__(self, max_bytes: int, max_age: float = None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()  # key -> (tags, versions, body, stored_at)
+        self._size = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    #function to invalidate every entry computed from the given kinds of data
+    def bump(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    #function to return the current versions of the given kinds of data
+    def versions(self, tags: tuple) -> tuple:
+        """
+        Read the versions before running a query, and store its result with them,
+        so a write landing while the query runs makes the new entry stale right away.
+        """
+        with self._lock:
+            return tuple(self._versions.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            tags, versions, body, stored_at = entry
+            expired = self.max_age is not None and time.monotonic() - stored_at > self.max_age
+            if expired or versions != tuple(self._versions.get(tag, 0) for tag in tags):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, tags: tuple, versions: tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (tags, versions, body, time.monotonic())
+            self._size += len(body)
+
+            # Evict the least recently used entries
+            while self._size > self.max_bytes:
+                _, (_, _, evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[2])
@@ -1,12 +1,29 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, g, jsonify
 from pymongo.errors import PyMongoError
 from bson.objectid import ObjectId
-from .stock_manager import get_total_stock, update_stock_after_sale
+from .stock_manager import (
+    ALLOCATION_STRATEGIES,
+    StockConflictError,
+    get_reserved_stock,
+    get_cart_reservations,
+    notify_stock_change,
+    release_reservations,
+    start_stock_session,
+    update_stock_after_cart_sale
+)
+from .wine_fields import effective_price
 from datetime import datetime
+from models.validation import validate_body
+from models.sale_model import SaleCart
 
 sales_bp = Blueprint('sales', __name__)
 
-def init_sale_routes(sales_collection, wines_collection, warehouses_collection):
+#attempts at a checkout whose stock was taken by a concurrent sale
+SALE_ATTEMPTS = 3
+
+def init_sale_routes(sales_collection, wines_collection, warehouses_collection, reservations_collection, invoice_writer, allocation_strategy):
+    if allocation_strategy not in ALLOCATION_STRATEGIES:
+        raise ValueError(f"Unknown allocation strategy: {allocation_strategy}")
     
     #Get customer's orders.
     # @sales_bp.route('/sales/customer/<account_id>', methods=['GET'])
@@ -21,52 +38,118 @@ def init_sale_routes(sales_collection, wines_collection, warehouses_collection):
     
     #Place customer's order.
     @sales_bp.route('/sales', methods=['POST'])
+    @validate_body(SaleCart)
     def process_sales_cart():
-        # Extract and validate JSON data
-        data = request.get_json()
-    
+        # Stock is read and written on the primary in one transaction, so concurrent
+        # checkouts can't sell the same bottles; a checkout that lost the race is retried
+        with start_stock_session(warehouses_collection) as session:
+            for attempt in range(SALE_ATTEMPTS):
+                try:
+                    response, status, changed_ids = session.with_transaction(lambda session: sell_cart(g.body, session))
+                    break
+                except StockConflictError:
+                    if attempt == SALE_ATTEMPTS - 1:
+                        return jsonify({
+                            "message": "Stock changed during checkout, please try again",
+                            "response_status": False
+                        }), 409
+
+        # Side effects that can't be rolled back wait for the commit
+        if changed_ids:
+            notify_stock_change(changed_ids)
+        new_invoice = response.get("invoice")
+        if new_invoice:
+            # Journaled and stored in the background by the invoice writer
+            invoice_writer.enqueue(new_invoice)
+            new_invoice["_id"] = str(new_invoice["_id"])
+            new_invoice["account_id"] = str(new_invoice["account_id"])
+        return jsonify(response), status
+
+    #function to sell the items of a cart that are in stock, returning the response with its invoice, the status and the wines whose stock changed
+    def sell_cart(data, session):
         account_id = data.get("account_id")
     
         items = data.get("items", [])
         
         shipping_address = data.get("shipping_address")
+        
+        # Holds placed by the cart while shopping
+        cart_id = data.get("cart_id")
+        held_items = get_cart_reservations(reservations_collection, cart_id, session) if cart_id else {}
+
+        # Slot allocation strategy, the configured default unless the order asks for another
+        strategy = data.get("allocation_strategy") or allocation_strategy
 
         total_price = 0
         insufficient_stock_items = []
         processed_items = []
-
+        
+        # Merge repeated wines into a single quantity per wine
+        quantities = {}
         for item in items:
-            wine_id = item.get("wine_id")
-            quantity_requested = item.get("quantity")
-    
-            # Update stock and process sale
-            sale_item = update_stock_after_sale(warehouses_collection, wine_id, quantity_requested)
-            
-            if not sale_item or not isinstance(sale_item, list) or "success" not in sale_item[0]:
-                return jsonify({"error": f"Failed to process item: {item}"}), 400
+            quantities[item.get("wine_id")] = quantities.get(item.get("wine_id"), 0) + item.get("quantity")
+
+        # Price the wines before touching stock; deleted wines and wines without a price can't be sold
+        wines = {str(wine["_id"]): wine for wine in wines_collection.find(
+            {"_id": {"$in": [ObjectId(wine_id) for wine_id in quantities]}}, session=session
+        )}
+        for wine_id in list(quantities):
+            if effective_price(wines.get(wine_id, {}).get("sale_price"), None) is None:
+                insufficient_stock_items.append({
+                    "wine_id": str(wine_id),
+                    "reason": "not_found" if wine_id not in wines else "no_price",
+                    "requested_quantity": int(quantities.pop(wine_id))
+                })
+
+        # A hold covering the quantity already guarantees the stock,
+        # otherwise stock held by other carts can't be sold
+        reserved_stock = {
+            wine_id: get_reserved_stock(reservations_collection, wine_id, exclude_cart_id=cart_id, session=session)
+            for wine_id, quantity_requested in quantities.items()
+            if held_items.get(wine_id, 0) < quantity_requested
+        }
+
+        # Allocate and update stock of the whole cart
+        sale_items = update_stock_after_cart_sale(
+                        warehouses_collection,
+                        quantities,
+                        strategy,
+                        shipping_address,
+                        reserved_stock,
+                        session,
+                        notify=False)
+
+
+        for wine_id, quantity_requested in quantities.items():
+            sale_item = sale_items[wine_id]
     
             if not sale_item[0]["success"]:
                 insufficient_stock_items.append({
                     "wine_id": str(wine_id),
+                    "reason": "insufficient_stock",
                     "available_stock": int(sale_item[0].get("stock", 0)),
                     "requested_quantity": int(quantity_requested)
                 })
             else:
-                wine = wines_collection.find_one({"_id": ObjectId(wine_id)})
+                wine = wines[wine_id]
+                discount = wine.get("discount") if isinstance(wine.get("discount"), (int, float)) else 0  # None means no discount
     
-                price_per_unit = round(wine["sale_price"] * (1 - wine["discount"]), 2)
+                price_per_unit = effective_price(wine["sale_price"], discount)
                 item_total = round(price_per_unit * quantity_requested, 2)
                 total_price += item_total
     
                 processed_items.append({
                     "wine_id": str(wine_id),
-                    "name": wine["name"],
+                    "name": wine.get("name"),
                     "sale_price": round(wine["sale_price"], 2),
-                    "discount": round(wine["discount"], 2),
+                    "discount": round(discount, 2),
                     "final_price_per_unit": price_per_unit,
                     "quantity": quantity_requested,
                     "item_total": item_total,
-                    "stock_location": sale_item[1:]
+                    "stock_location": {
+                        "strategy": sale_item[0]["strategy"],
+                        "locations": sale_item[1:]
+                    }
                 })
                 
         response = {
@@ -77,16 +160,21 @@ def init_sale_routes(sales_collection, wines_collection, warehouses_collection):
         # Issue new invoice
         if processed_items:
             new_invoice = {
+                "_id": ObjectId(),  # Assigned here, so the invoice can be returned before it is stored
                 "account_id": ObjectId(account_id),
                 "items": processed_items,
                 "total_price": round(total_price, 2),
                 "sales_date": str(datetime.utcnow()),
                 "shipping_address": shipping_address
             }
-            result = sales_collection.insert_one(new_invoice)
-            new_invoice["_id"] = str(result.inserted_id)
-            new_invoice["account_id"] = str(new_invoice["account_id"])
-    
             response["invoice"] = new_invoice
+            
+            # Holds are converted into the depletions above
+            if cart_id:
+                release_reservations(reservations_collection, cart_id, session=session, notify=False)
 
-        return jsonify(response), 200
\ No newline at end of file
+        # Wines whose stock changed: the ones sold and the ones whose holds were released
+        changed_ids = [item["wine_id"] for item in processed_items]
+        if processed_items and cart_id:
+            changed_ids += list(held_items)
+        return response, 200, list(dict.fromkeys(changed_ids))
\ No newline at end of file
@@ -1,13 +1,48 @@
-from flask import Blueprint
+from flask import Blueprint, g, jsonify
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import re
+from datetime import datetime, timedelta
+from math import asin, cos, radians, sin, sqrt
+from models.validation import validate_body, validate_query
+from models.stock_model import Reservation, ReplenishmentQuery, ReservationReleaseQuery
 
 stock_manager_bp = Blueprint('warehouse_stock', __name__)
 
+#raised when stock changed between reading the slots and deducting from them
+class StockConflictError(Exception):
+    pass
+
+#callbacks notified with the wine_ids whose stock changed (None when unknown)
+_stock_listeners = []
+
+#function to register a callback notified of stock changes
+def add_stock_listener(listener):
+    _stock_listeners.append(listener)
+
+#function to notify the registered callbacks of a stock change
+def notify_stock_change(wine_ids=None):
+    for listener in _stock_listeners:
+        listener(wine_ids)
+
+#function to start a session for stock-sensitive requests
+def start_stock_session(collection):
+    """
+    Start a causally consistent session on the client of a collection. Reads in the
+    session see the writes made before them in the same session, even with catalog
+    reads routed to secondaries.
+    :param collection: Any collection of the client.
+    :return: The client session, to be used as a context manager.
+    """
+    return collection.database.client.start_session(causal_consistency=True)
+
 #function to return the total stock of a specific wine
-def get_total_stock(warehouses_collection, wine_id: str) -> str:
+def get_total_stock(warehouses_collection, wine_id: str, session=None) -> str:
     """
     Calculate the total stock for a given wine_id.
     :param warehouses_collection: The MongoDB collection for warehouses.
     :param wine_id: The wine_id to search for.
+    :param session: Optional client session the reads and writes run in.
     :return: Total stock for the given wine_id.
     """
     pipeline = [
@@ -24,7 +59,7 @@ def get_total_stock(warehouses_collection, wine_id: str) -> str:
     ]
 
     # Execute the aggregation
-    result = list(warehouses_collection.aggregate(pipeline))
+    result = list(warehouses_collection.aggregate(pipeline, session=session))
 
     # Return the total stock if found, else return 0
     return result[0]["total_stock"] if result else "0"
@@ -58,120 +93,442 @@ def get_wine_locations_and_stock(warehouses_collection, wine_id: str) -> list:
     # Return the list of wine locations and stocks
     return result
     
-#function to update stock after sale. It returns ...
-def update_stock_after_sale(warehouses_collection, wine_id: str, quantity_requested: int) -> list:
+#function to sort aisle and shelf ids the way they are walked, e.g. A2 before A10
+def pick_path_key(value) -> tuple:
+    return tuple(int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", str(value)))
+
+#function to return the locations of many wines grouped by warehouse, in pick path order
+def get_wines_locations_by_warehouse(warehouses_collection, wine_ids: list):
     """
-    Deduct the sale amount from the stock of a specified wine_id and distribute it across locations (aisles and shelves).
+    Retrieve the locations (aisle and shelf) and stock of many wines with a single aggregation.
+    Warehouses are yielded one at a time as the cursor is read, so large requests can be streamed.
     :param warehouses_collection: The MongoDB collection for warehouses.
-    :param wine_id: The wine_id to search for.
-    :param sale_amount: The amount of stock to deduct.
-    :return: List of dictionaries with updated stock and location details.
+    :param wine_ids: The wine_ids to search for.
+    :return: Generator of dictionaries with the warehouse and its picks sorted by aisle and shelf.
     """
     pipeline = [
+        {"$match": {"aisles.shelves.wines.wine_id": {"$in": wine_ids}}},  # Skip warehouses without the wines
         {"$unwind": "$aisles"},  # Unwind aisles array
         {"$unwind": "$aisles.shelves"},  # Unwind shelves array
         {"$unwind": "$aisles.shelves.wines"},  # Unwind wines array
-        {"$match": {"aisles.shelves.wines.wine_id": wine_id}},  # Filter by wine_id
+        {"$match": {"aisles.shelves.wines.wine_id": {"$in": wine_ids}, "aisles.shelves.wines.stock": {"$gt": 0}}},
         {
             "$project": {
                 "_id": 0,
                 "warehouse_id": "$_id",  # Include warehouse ID
+                "location": "$location",  # Include warehouse location name
                 "aisle": "$aisles.aisle",  # Include aisle ID
                 "shelf": "$aisles.shelves.shelf",  # Include shelf ID
+                "wine_id": "$aisles.shelves.wines.wine_id",  # Include wine ID
                 "stock": "$aisles.shelves.wines.stock"  # Include wine stock
             }
         },
-        {"$sort": {"stock": 1}}  # Sort by stock in ascending order to deplete smallest stocks first
+        {"$sort": {"warehouse_id": 1}}  # Keep the slots of a warehouse together
     ]
 
-    # Retrieve wine locations and stocks
-    locations = list(warehouses_collection.aggregate(pipeline))
-    
-    # verify if total stock fulfills sale
-    if not locations:
-        return [{"success": False, "stock": 0}]
-    
-    total_stock = sum(location["stock"] for location in locations)
-    if total_stock < quantity_requested:
-        return [{"success": False, "stock": total_stock}]
-    
-    remaining_sale = quantity_requested
-    updated_locations = []
-    updated_locations.append({"success": True})
+    def warehouse_group(slots):
+        slots.sort(key=lambda slot: (pick_path_key(slot["aisle"]), pick_path_key(slot["shelf"]), slot["wine_id"]))
+        return {
+            "warehouse_id": str(slots[0]["warehouse_id"]),
+            "location": slots[0].get("location"),
+            "picks": [
+                {"aisle": slot["aisle"], "shelf": slot["shelf"], "wine_id": slot["wine_id"], "stock": slot["stock"]}
+                for slot in slots
+            ]
+        }
+
+    slots = []
+    for slot in warehouses_collection.aggregate(pipeline):
+        if slots and slot["warehouse_id"] != slots[0]["warehouse_id"]:
+            yield warehouse_group(slots)
+            slots = []
+        slots.append(slot)
+    if slots:
+        yield warehouse_group(slots)
+
+#function to return the stock slots of every wine in a cart
+def get_cart_stock_slots(warehouses_collection, wine_ids: list, session=None) -> dict:
+    """
+    Retrieve the locations holding stock of any of the given wines with a single aggregation.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param wine_ids: The wine_ids to search for.
+    :param session: Optional client session the reads and writes run in.
+    :return: Dictionary of wine_id -> list of slots (warehouse, aisle, shelf and stock).
+    """
+    pipeline = [
+        {"$match": {"aisles.shelves.wines.wine_id": {"$in": wine_ids}}},  # Skip warehouses without the wines
+        {"$unwind": "$aisles"},  # Unwind aisles array
+        {"$unwind": "$aisles.shelves"},  # Unwind shelves array
+        {"$unwind": "$aisles.shelves.wines"},  # Unwind wines array
+        {"$match": {"aisles.shelves.wines.wine_id": {"$in": wine_ids}, "aisles.shelves.wines.stock": {"$gt": 0}}},
+        {
+            "$project": {
+                "_id": 0,
+                "warehouse_id": "$_id",  # Include warehouse ID
+                "location": "$location",  # Include warehouse location name
+                "coordinates": "$coordinates",  # Include warehouse coordinates, if registered
+                "aisle": "$aisles.aisle",  # Include aisle ID
+                "shelf": "$aisles.shelves.shelf",  # Include shelf ID
+                "wine_id": "$aisles.shelves.wines.wine_id",  # Include wine ID
+                "stock": "$aisles.shelves.wines.stock"  # Include wine stock
+            }
+        }
+    ]
+
+    slots_by_wine = {wine_id: [] for wine_id in wine_ids}
+    for slot in warehouses_collection.aggregate(pipeline, session=session):
+        slots_by_wine[slot["wine_id"]].append(slot)
+    return slots_by_wine
 
-    for location in locations:
-        if remaining_sale <= 0:
+#function to drain slots in the given order until the quantity is reached
+def _take_from_slots(slots: list, quantity: int) -> list:
+    picks = []
+    for slot in slots:
+        if quantity <= 0:
             break
+        deduct_amount = min(slot["stock"], quantity)
+        quantity -= deduct_amount
+        picks.append((slot, deduct_amount))
+    return picks
 
-        deduct_amount = min(location["stock"], remaining_sale)
-        remaining_sale -= deduct_amount
-        
-        # Update stock in the database
-        warehouses_collection.update_one(
-            {
-                "_id": location["warehouse_id"],
-                "aisles.aisle": location["aisle"],
-                "aisles.shelves.shelf": location["shelf"],
-                "aisles.shelves.wines.wine_id": wine_id
-            },
-            {"$inc": {"aisles.$[aisle].shelves.$[shelf].wines.$[wine].stock": -deduct_amount}},
-            array_filters=[
-                {"aisle.aisle": location["aisle"]},
-                {"shelf.shelf": location["shelf"]},
-                {"wine.wine_id": wine_id}
-            ]
-        )
+#function to pick a wine from as few slots as possible
+def _take_fewest_slots(slots: list, quantity: int) -> list:
+    # A single slot covering the quantity is enough; use the smallest one to keep large slots whole
+    covering = [slot for slot in slots if slot["stock"] >= quantity]
+    if covering:
+        return [(min(covering, key=lambda slot: slot["stock"]), quantity)]
+    return _take_from_slots(sorted(slots, key=lambda slot: -slot["stock"]), quantity)
 
-        # Add updated location to the response
-        updated_locations.append(
-            f"warehouse_id: {location['warehouse_id']}\n"
-            f"aisle: {location['aisle']}\n"
-            f"shelf: {location['shelf']}"
-        )
+#function to pick every wine warehouse by warehouse, following a warehouse ranking
+def _allocate_by_warehouse_rank(slots_by_wine: dict, quantities: dict, warehouse_rank: list) -> dict:
+    rank = {warehouse_id: position for position, warehouse_id in enumerate(warehouse_rank)}
+    allocation = {}
+    for wine_id, quantity in quantities.items():
+        slots_by_warehouse = {}
+        for slot in slots_by_wine[wine_id]:
+            slots_by_warehouse.setdefault(slot["warehouse_id"], []).append(slot)
 
-    return updated_locations
-    
-    '''
-    Return Format:
-    List of dictionaries, each containing:
-        warehouse_id: The ID of the warehouse.
-        aisle: The aisle ID.
-        shelf: The shelf ID.
-        remaining_stock: Updated stock after the sale.
-        
-    Call:
-    update_stock_after_sale(warehouses_collection, "W001", 35)
-    
-    [ {"warehouse_id": "WH1", "aisle": "A1", "shelf": "S1", "stock": 10},
-    {"warehouse_id": "WH1", "aisle": "A1", "shelf": "S2", "stock": 15},
-    {"warehouse_id": "WH2", "aisle": "A2", "shelf": "S3", "stock": 20} ]
-    
-    [ {"warehouse_id": "WH1", "aisle": "A1", "shelf": "S1", "remaining_stock": 0},
-    {"warehouse_id": "WH1", "aisle": "A1", "shelf": "S2", "remaining_stock": 0},
-    {"warehouse_id": "WH2", "aisle": "A2", "shelf": "S3", "remaining_stock": 10} ]
+        picks = []
+        for warehouse_id in sorted(slots_by_warehouse, key=lambda warehouse_id: rank.get(warehouse_id, len(rank))):
+            remaining = quantity - sum(amount for _, amount in picks)
+            if remaining <= 0:
+                break
+            picks.extend(_take_fewest_slots(slots_by_warehouse[warehouse_id], remaining))
+        allocation[wine_id] = picks
+    return allocation
+
+#allocation strategy: drain the smallest slots first
+def allocate_smallest_first(slots_by_wine: dict, quantities: dict, shipping_address=None) -> dict:
+    return {
+        wine_id: _take_from_slots(sorted(slots_by_wine[wine_id], key=lambda slot: slot["stock"]), quantity)
+        for wine_id, quantity in quantities.items()
+    }
+
+#allocation strategy: pick each wine from as few slots as possible
+def allocate_fewest_slots(slots_by_wine: dict, quantities: dict, shipping_address=None) -> dict:
+    return {
+        wine_id: _take_fewest_slots(slots_by_wine[wine_id], quantity)
+        for wine_id, quantity in quantities.items()
+    }
+
+#allocation strategy: ship the cart from as few warehouses as possible
+def allocate_single_warehouse_first(slots_by_wine: dict, quantities: dict, shipping_address=None) -> dict:
+    # Rank warehouses by how many cart items they can fully supply, then by units they can supply
+    coverage = {}
+    for wine_id, quantity in quantities.items():
+        stock_by_warehouse = {}
+        for slot in slots_by_wine[wine_id]:
+            stock_by_warehouse[slot["warehouse_id"]] = stock_by_warehouse.get(slot["warehouse_id"], 0) + slot["stock"]
+        for warehouse_id, stock in stock_by_warehouse.items():
+            items, units = coverage.get(warehouse_id, (0, 0))
+            coverage[warehouse_id] = (items + (stock >= quantity), units + min(stock, quantity))
+
+    warehouse_rank = sorted(coverage, key=lambda warehouse_id: coverage[warehouse_id], reverse=True)
+    return _allocate_by_warehouse_rank(slots_by_wine, quantities, warehouse_rank)
+
+#function to return the distance between a warehouse and a shipping address
+def _warehouse_distance(slot: dict, shipping_address) -> float:
+    coordinates = slot.get("coordinates")
+    if isinstance(shipping_address, dict) and coordinates:
+        try:
+            latitude_1, longitude_1 = map(radians, (coordinates["latitude"], coordinates["longitude"]))
+            latitude_2, longitude_2 = map(radians, (shipping_address["latitude"], shipping_address["longitude"]))
+        except (KeyError, TypeError):
+            pass
+        else:
+            # Haversine distance in kilometers
+            a = sin((latitude_2 - latitude_1) / 2) ** 2 + cos(latitude_1) * cos(latitude_2) * sin((longitude_2 - longitude_1) / 2) ** 2
+            return 6371 * 2 * asin(sqrt(a))
+
+    # Without coordinates, a warehouse whose location is named in the address is the nearest
+    address = " ".join(str(value) for value in shipping_address.values()) if isinstance(shipping_address, dict) else str(shipping_address or "")
+    location = str(slot.get("location") or "")
+    return 0 if location and location.lower() in address.lower() else float("inf")
 
-    {"error": "Insufficient stock to fulfill the sale amount."}
-    '''
+#allocation strategy: pick from the warehouses nearest to the shipping address
+def allocate_nearest_warehouse(slots_by_wine: dict, quantities: dict, shipping_address=None) -> dict:
+    distances = {}
+    for slots in slots_by_wine.values():
+        for slot in slots:
+            if slot["warehouse_id"] not in distances:
+                distances[slot["warehouse_id"]] = _warehouse_distance(slot, shipping_address)
+
+    warehouse_rank = sorted(distances, key=lambda warehouse_id: distances[warehouse_id])
+    return _allocate_by_warehouse_rank(slots_by_wine, quantities, warehouse_rank)
+
+#available allocation strategies by name
+ALLOCATION_STRATEGIES = {
+    "smallest_first": allocate_smallest_first,
+    "fewest_slots": allocate_fewest_slots,
+    "single_warehouse": allocate_single_warehouse_first,
+    "nearest_warehouse": allocate_nearest_warehouse
+}
+
+#function to update stock of a whole cart after sale
+def update_stock_after_cart_sale(
+    warehouses_collection,
+    quantities: dict,
+    strategy: str = "smallest_first",
+    shipping_address=None,
+    reserved_stock: dict = None,
+    session=None,
+    notify: bool = True) -> dict:
+    """
+    Deduct the sale amounts of every wine in a cart from the warehouses.
+    The candidate slots of the whole cart are read in one aggregation, the allocation
+    strategy picks the slots in memory and all deductions are sent in one bulk write.
+    Each deduction only applies while its slot still holds the amount; when another sale
+    took it first, StockConflictError is raised, so callers run this in a transaction.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param quantities: Dictionary of wine_id -> quantity requested.
+    :param strategy: Name of the allocation strategy in ALLOCATION_STRATEGIES.
+    :param shipping_address: The shipping address, used by location-aware strategies.
+    :param reserved_stock: Dictionary of wine_id -> stock held by other carts, which can't be sold.
+    :param session: Optional client session the reads and writes run in.
+    :param notify: Notify the stock listeners; callers in a transaction notify after it commits.
+    :return: Dictionary of wine_id -> list with the success flag followed by the picked locations.
+    """
+    reserved_stock = reserved_stock or {}
+    slots_by_wine = get_cart_stock_slots(warehouses_collection, list(quantities), session)
+
+    # verify if total stock fulfills each sale
+    results = {}
+    fulfillable = {}
+    for wine_id, quantity_requested in quantities.items():
+        total_stock = sum(slot["stock"] for slot in slots_by_wine[wine_id]) - reserved_stock.get(wine_id, 0)
+        if total_stock < quantity_requested:
+            results[wine_id] = [{"success": False, "stock": max(total_stock, 0)}]
+        else:
+            fulfillable[wine_id] = quantity_requested
+
+    allocation = ALLOCATION_STRATEGIES[strategy](slots_by_wine, fulfillable, shipping_address)
+
+    operations = []
+    for wine_id, picks in allocation.items():
+        updated_locations = [{"success": True, "strategy": strategy}]
+        for slot, deduct_amount in picks:
+            operations.append(UpdateOne(
+                {"_id": slot["warehouse_id"]},
+                {"$inc": {"aisles.$[aisle].shelves.$[shelf].wines.$[wine].stock": -deduct_amount}},
+                array_filters=[
+                    {"aisle.aisle": slot["aisle"]},
+                    {"shelf.shelf": slot["shelf"]},
+                    {"wine.wine_id": wine_id, "wine.stock": {"$gte": deduct_amount}}
+                ]
+            ))
+
+            # Add updated location to the response
+            updated_locations.append(
+                f"warehouse_id: {slot['warehouse_id']}\n"
+                f"aisle: {slot['aisle']}\n"
+                f"shelf: {slot['shelf']}\n"
+                f"quantity: {deduct_amount}"
+            )
+        results[wine_id] = updated_locations
+
+    # Update stock in the database
+    if operations:
+        result = warehouses_collection.bulk_write(operations, ordered=False, session=session)
+        if result.modified_count != len(operations):
+            raise StockConflictError("Stock changed during the sale")
+        if notify:
+            notify_stock_change(list(allocation))
+
+    return results
+
+#function to update stock after sale. It returns ...
+def update_stock_after_sale(
+    warehouses_collection,
+    wine_id: str,
+    quantity_requested: int,
+    reserved_stock: int = 0,
+    strategy: str = "smallest_first",
+    session=None) -> list:
+    """
+    Deduct the sale amount from the stock of a specified wine_id and distribute it across locations (aisles and shelves).
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param wine_id: The wine_id to search for.
+    :param sale_amount: The amount of stock to deduct.
+    :param reserved_stock: Stock held by other carts, which can't be sold.
+    :param strategy: Name of the allocation strategy in ALLOCATION_STRATEGIES.
+    :param session: Optional client session the reads and writes run in.
+    :return: List with the success flag followed by the updated locations.
+    """
+    results = update_stock_after_cart_sale(
+        warehouses_collection,
+        {wine_id: quantity_requested},
+        strategy,
+        reserved_stock={wine_id: reserved_stock},
+        session=session
+    )
+    return results[wine_id]
+
+#cache of warehouse location name -> warehouse _id
+_warehouse_ids = {}
 
 #function to return warehouse id
 def get_warehouse_id(warehouses_collection, warehouse_name: str) -> str:
-    # Query to find the document by location
-    query = {"location": warehouse_name}
-    projection = {"_id": 1}  # Only return the _id field
-
-    # Fetch the document
-    document = warehouses_collection.find_one(query, projection)
+    """
+    Resolve a warehouse location name to its _id, creating the warehouse if it doesn't exist.
+    Resolved ids are cached, so only the first call per location reaches the database.
+    Locations are unique, so concurrent first calls all resolve to the same warehouse.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param warehouse_name: The warehouse location name.
+    :return: The _id of the warehouse.
+    """
+    warehouse_id = _warehouse_ids.get(warehouse_name)
+    if warehouse_id is not None:
+        return warehouse_id
 
-    # If the document is not found, create it and return its _id
-    if document is None:
-        # Create a new document with the specified location
-        new_document = {"location": warehouse_name}
-        result = warehouses_collection.insert_one(new_document)
-        return result.inserted_id
+    # Find or create the warehouse in a single round trip
+    for attempt in range(2):
+        try:
+            document = warehouses_collection.find_one_and_update(
+                {"location": warehouse_name},
+                {"$setOnInsert": {"location": warehouse_name}},
+                projection={"_id": 1},  # Only return the _id field
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # A concurrent call created it first; the retry finds it
+            if attempt:
+                raise
 
-    # Return the _id of the existing document
+    _warehouse_ids[warehouse_name] = document["_id"]
     return document["_id"]
-    
+
+#function to build the write operations for a stock intake at one warehouse
+def build_stock_intake_operations(warehouse_id, slots: list) -> list:
+    """
+    Build the bulk write operations that add stock to a list of slots in a warehouse.
+    Missing aisles, shelves and wines are created by guarded $push operations that only
+    match while the element is absent, so the whole list can be sent in one ordered
+    bulk_write without reading the warehouse first and without racing concurrent intakes.
+    :param warehouse_id: The ID of the warehouse.
+    :param slots: List of dictionaries with aisle, shelf, wine_id and stock.
+    :return: List of pymongo write operations.
+    """
+    # Merge repeated slots so each wine gets a single increment
+    totals = {}
+    for slot in slots:
+        key = (slot["aisle"], slot["shelf"], slot["wine_id"])
+        totals[key] = totals.get(key, 0) + slot["stock"]
+
+    aisles = {}
+    for (aisle, shelf, wine_id) in totals:
+        aisles.setdefault(aisle, {}).setdefault(shelf, []).append(wine_id)
+
+    operations = []
+    for aisle, shelves in aisles.items():
+        # Create the aisle if it doesn't exist
+        operations.append(UpdateOne(
+            {"_id": warehouse_id, "aisles.aisle": {"$ne": aisle}},
+            {"$push": {"aisles": {"aisle": aisle, "shelves": []}}}
+        ))
+        for shelf, wine_ids in shelves.items():
+            # Create the shelf if it doesn't exist in the aisle
+            operations.append(UpdateOne(
+                {"_id": warehouse_id, "aisles": {"$elemMatch": {"aisle": aisle, "shelves.shelf": {"$ne": shelf}}}},
+                {"$push": {"aisles.$[aisle].shelves": {"shelf": shelf, "wines": []}}},
+                array_filters=[{"aisle.aisle": aisle}]
+            ))
+            for wine_id in wine_ids:
+                # Create the wine with no stock if it isn't on the shelf yet
+                operations.append(UpdateOne(
+                    {
+                        "_id": warehouse_id,
+                        "aisles": {"$elemMatch": {
+                            "aisle": aisle,
+                            "shelves": {"$elemMatch": {"shelf": shelf, "wines.wine_id": {"$ne": wine_id}}}
+                        }}
+                    },
+                    {"$push": {"aisles.$[aisle].shelves.$[shelf].wines": {"wine_id": wine_id, "stock": 0}}},
+                    array_filters=[{"aisle.aisle": aisle}, {"shelf.shelf": shelf}]
+                ))
+
+    # Increment the stock once every slot is known to exist
+    for (aisle, shelf, wine_id), stock_to_add in totals.items():
+        operations.append(UpdateOne(
+            {"_id": warehouse_id},
+            {"$inc": {"aisles.$[aisle].shelves.$[shelf].wines.$[wine].stock": stock_to_add}},
+            array_filters=[
+                {"aisle.aisle": aisle},  # Array filter for the aisle
+                {"shelf.shelf": shelf},  # Array filter for the shelf
+                {"wine.wine_id": wine_id}  # Array filter for the wine
+            ]
+        ))
+
+    return operations
+
+#function to add stock to many slots of a warehouse at once
+def apply_stock_intake(warehouses_collection, warehouse_id, slots: list) -> dict:
+    """
+    Add stock to every given slot (aisle, shelf, wine) of a warehouse with a single bulk write.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param warehouse_id: The ID of the warehouse.
+    :param slots: List of dictionaries with aisle, shelf, wine_id and stock.
+    :return: A dictionary indicating success or failure of the operation.
+    """
+    operations = build_stock_intake_operations(warehouse_id, slots)
+    if not operations:
+        return {"success": False, "message": "No stock to add."}
+
+    result = warehouses_collection.bulk_write(operations, ordered=True)
+    notify_stock_change(list({slot["wine_id"] for slot in slots}))
+
+    # The increments always match an existing warehouse, even when they add zero
+    if result.matched_count > 0:
+        return {"success": True, "message": "Wine stock updated or added successfully."}
+    else:
+        return {"success": False, "message": "Warehouse not found."}
+
+#function to add stock to slots of many warehouses at once
+def apply_stock_intakes(warehouses_collection, slots_by_warehouse: dict, session=None, notify: bool = True) -> dict:
+    """
+    Add stock to slots spread over many warehouses with a single bulk write.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param slots_by_warehouse: Dictionary of warehouse_id -> list of slots (aisle, shelf, wine_id and stock).
+    :param session: Optional client session the writes run in.
+    :param notify: Notify the stock listeners; callers in a transaction notify after it commits.
+    :return: A dictionary indicating success or failure of the operation.
+    """
+    operations = []
+    for warehouse_id, slots in slots_by_warehouse.items():
+        operations.extend(build_stock_intake_operations(warehouse_id, slots))
+    if not operations:
+        return {"success": False, "message": "No stock to add."}
+
+    result = warehouses_collection.bulk_write(operations, ordered=True, session=session)
+    if notify:
+        notify_stock_change(list({slot["wine_id"] for slots in slots_by_warehouse.values() for slot in slots}))
+
+    if result.matched_count > 0:
+        return {"success": True, "message": "Wine stock updated or added successfully."}
+    else:
+        return {"success": False, "message": "Warehouse not found."}
+
 #function to update stock at the warehouse
 def update_wine_stock(
     warehouses_collection,
@@ -191,75 +548,414 @@ def update_wine_stock(
     :param stock_to_add: The stock to add to the wine.
     :return: A dictionary indicating success or failure of the operation.
     """
-    # Step 1: Try to update the stock if the wine_id already exists at the location
-    result = warehouses_collection.update_one(
+    return apply_stock_intake(
+        warehouses_collection,
+        warehouse_id,
+        [{"aisle": aisle, "shelf": shelf, "wine_id": wine_id, "stock": stock_to_add}]
+    )
+
+#function to return the stock of a wine held by active reservations
+def get_reserved_stock(reservations_collection, wine_id: str, exclude_cart_id: str = None, session=None) -> int:
+    """
+    Calculate the stock of a wine held by reservations that haven't expired yet.
+    :param reservations_collection: The MongoDB collection for reservations.
+    :param wine_id: The wine_id to search for.
+    :param exclude_cart_id: Cart whose reservations shouldn't be counted.
+    :param session: Optional client session the reads and writes run in.
+    :return: Total reserved stock for the given wine_id.
+    """
+    match = {"wine_id": wine_id, "expires_at": {"$gt": datetime.utcnow()}}
+    if exclude_cart_id:
+        match["cart_id"] = {"$ne": exclude_cart_id}
+
+    pipeline = [
+        {"$match": match},  # Filter by wine_id and active reservations
+        {"$group": {"_id": "$wine_id", "reserved": {"$sum": "$quantity"}}}
+    ]
+
+    result = list(reservations_collection.aggregate(pipeline, session=session))
+    return result[0]["reserved"] if result else 0
+
+#function to return the stock of a wine that can still be sold or reserved
+def get_available_stock(warehouses_collection, reservations_collection, wine_id: str) -> int:
+    """
+    Calculate the stock of a wine that isn't held by any active reservation.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param reservations_collection: The MongoDB collection for reservations.
+    :param wine_id: The wine_id to search for.
+    :return: Available stock for the given wine_id.
+    """
+    total_stock = int(get_total_stock(warehouses_collection, wine_id))
+    return max(total_stock - get_reserved_stock(reservations_collection, wine_id), 0)
+
+#function to return the available stock of many wines at once
+def get_total_stock_for_wines(warehouses_collection, wine_ids: list = None) -> dict:
+    """
+    Calculate the stock of many wines across every warehouse with a single aggregation.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param wine_ids: The wine_ids to search for, or None for every wine in stock.
+    :return: Dictionary of wine_id -> total stock.
+    """
+    wine_match = {"$in": wine_ids} if wine_ids is not None else {"$exists": True}
+    stock_pipeline = [
+        {"$match": {"aisles.shelves.wines.wine_id": wine_match}},  # Skip warehouses without the wines
+        {"$unwind": "$aisles"},  # Unwind aisles array
+        {"$unwind": "$aisles.shelves"},  # Unwind shelves array
+        {"$unwind": "$aisles.shelves.wines"},  # Unwind wines array
+        {"$match": {"aisles.shelves.wines.wine_id": wine_match}},  # Filter by wine_ids
+        {"$group": {"_id": "$aisles.shelves.wines.wine_id", "total_stock": {"$sum": "$aisles.shelves.wines.stock"}}}
+    ]
+
+    stock = {wine_id: 0 for wine_id in wine_ids or []}
+    for result in warehouses_collection.aggregate(stock_pipeline):
+        stock[result["_id"]] = result["total_stock"]
+    return stock
+
+#function to return the available stock of many wines at once
+def get_available_stock_for_wines(warehouses_collection, reservations_collection, wine_ids: list = None) -> dict:
+    """
+    Calculate the stock not held by active reservations for many wines, with one aggregation per collection.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param reservations_collection: The MongoDB collection for reservations.
+    :param wine_ids: The wine_ids to search for, or None for every wine in stock.
+    :return: Dictionary of wine_id -> available stock.
+    """
+    wine_match = {"$in": wine_ids} if wine_ids is not None else {"$exists": True}
+    reserved_pipeline = [
+        {"$match": {"wine_id": wine_match, "expires_at": {"$gt": datetime.utcnow()}}},
+        {"$group": {"_id": "$wine_id", "reserved": {"$sum": "$quantity"}}}
+    ]
+
+    stock = get_total_stock_for_wines(warehouses_collection, wine_ids)
+    for result in reservations_collection.aggregate(reserved_pipeline):
+        stock[result["_id"]] = max(stock.get(result["_id"], 0) - result["reserved"], 0)
+    return stock
+
+#function to return the active reservations of a cart
+def get_cart_reservations(reservations_collection, cart_id: str, session=None) -> dict:
+    """
+    Retrieve the quantities held by the active reservations of a cart.
+    :param reservations_collection: The MongoDB collection for reservations.
+    :param cart_id: The cart to search for.
+    :param session: Optional client session the reads and writes run in.
+    :return: Dictionary of wine_id -> reserved quantity.
+    """
+    reservations = reservations_collection.find(
+        {"cart_id": cart_id, "expires_at": {"$gt": datetime.utcnow()}},
+        {"_id": 0, "wine_id": 1, "quantity": 1},
+        session=session
+    )
+    return {reservation["wine_id"]: reservation["quantity"] for reservation in reservations}
+
+#function to place or refresh a time-limited hold on a wine's stock
+def reserve_stock(
+    warehouses_collection,
+    reservations_collection,
+    cart_id: str,
+    wine_id: str,
+    quantity: int,
+    ttl_seconds: int,
+    session=None) -> dict:
+    """
+    Hold a quantity of a wine for a cart until the reservation expires.
+    The hold is written first and checked against the stock afterwards, so two carts
+    racing for the last bottles can both be refused but never both be accepted.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param reservations_collection: The MongoDB collection for reservations.
+    :param cart_id: The cart placing the hold.
+    :param wine_id: The wine to hold.
+    :param quantity: The quantity to hold, replacing any previous hold of the cart.
+    :param ttl_seconds: How long the hold lasts.
+    :param session: Optional client session the reads and writes run in.
+    :return: A dictionary indicating success or failure and the available stock.
+    """
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+
+    previous = reservations_collection.find_one_and_update(
+        {"cart_id": cart_id, "wine_id": wine_id},
+        {"$set": {"quantity": quantity, "expires_at": expires_at}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+        session=session
+    )
+
+    total_stock = int(get_total_stock(warehouses_collection, wine_id, session))
+    reserved = get_reserved_stock(reservations_collection, wine_id, session=session)
+
+    if reserved > total_stock:
+        # Roll back to the previous hold, if it was still active
+        if previous and previous["expires_at"] > now:
+            reservations_collection.update_one(
+                {"cart_id": cart_id, "wine_id": wine_id},
+                {"$set": {"quantity": previous["quantity"], "expires_at": previous["expires_at"]}},
+                session=session
+            )
+        else:
+            reservations_collection.delete_one({"cart_id": cart_id, "wine_id": wine_id}, session=session)
+        return {"success": False, "stock": max(total_stock - (reserved - quantity), 0)}
+
+    notify_stock_change([wine_id])
+    return {"success": True, "stock": total_stock - reserved, "expires_at": expires_at}
+
+#function to release the holds of a cart
+def release_reservations(reservations_collection, cart_id: str, wine_id: str = None, session=None, notify: bool = True) -> int:
+    """
+    Remove the holds of a cart, or only the hold on one wine.
+    :param reservations_collection: The MongoDB collection for reservations.
+    :param cart_id: The cart whose holds are released.
+    :param wine_id: Optional wine to release.
+    :param session: Optional client session the reads and writes run in.
+    :param notify: Notify the stock listeners; callers in a transaction notify after it commits.
+    :return: Number of holds removed.
+    """
+    query = {"cart_id": cart_id}
+    if wine_id:
+        query["wine_id"] = wine_id
+        wine_ids = [wine_id]
+    else:
+        wine_ids = reservations_collection.distinct("wine_id", query, session=session)
+    deleted_count = reservations_collection.delete_many(query, session=session).deleted_count
+    if deleted_count and notify:
+        notify_stock_change(wine_ids)
+    return deleted_count
+
+#function to build the inventory matrix pipeline, run on the warehouses collection
+def build_inventory_matrix_pipeline(warehouse_ids: list = None, wine_ids: list = None) -> list:
+    """
+    Build the aggregation summing the stock of every (wine, warehouse) pair in one pass.
+    Each output document is one row of the matrix: a wine with the warehouses holding
+    it and the stock in each, so pairs without stock never leave the server.
+    :param warehouse_ids: Optional warehouse _ids to restrict the columns to.
+    :param wine_ids: Optional wine_ids to restrict the rows to.
+    :return: Aggregation pipeline, sorted by wine_id.
+    """
+    match = {}
+    if warehouse_ids is not None:
+        match["_id"] = {"$in": warehouse_ids}
+    if wine_ids is not None:
+        match["aisles.shelves.wines.wine_id"] = {"$in": wine_ids}  # Skip warehouses without the wines
+
+    pipeline = [{"$match": match}] if match else []
+    pipeline += [
+        {"$unwind": "$aisles"},  # Unwind aisles array
+        {"$unwind": "$aisles.shelves"},  # Unwind shelves array
+        {"$unwind": "$aisles.shelves.wines"}  # Unwind wines array
+    ]
+    if wine_ids is not None:
+        pipeline.append({"$match": {"aisles.shelves.wines.wine_id": {"$in": wine_ids}}})
+    pipeline += [
         {
-            "_id": warehouse_id,  # Match the warehouse
-            "aisles.aisle": aisle,  # Match the aisle
-            "aisles.shelves.shelf": shelf,  # Match the shelf
-            "aisles.shelves.wines.wine_id": wine_id  # Match the wine
+            "$group": {  # Sum the slots of a wine in a warehouse
+                "_id": {"wine_id": "$aisles.shelves.wines.wine_id", "warehouse_id": "$_id"},
+                "stock": {"$sum": "$aisles.shelves.wines.stock"}
+            }
         },
+        {"$match": {"stock": {"$ne": 0}}},
+        {"$sort": {"_id.wine_id": 1, "_id.warehouse_id": 1}},
         {
-            "$inc": {  # Increment the stock by stock_to_add
-                "aisles.$[aisle].shelves.$[shelf].wines.$[wine].stock": stock_to_add
+            "$group": {  # One row per wine
+                "_id": "$_id.wine_id",
+                "warehouse_ids": {"$push": "$_id.warehouse_id"},
+                "stock": {"$push": "$stock"}
             }
         },
-        array_filters=[
-            {"aisle.aisle": aisle},  # Array filter for the aisle
-            {"shelf.shelf": shelf},  # Array filter for the shelf
-            {"wine.wine_id": wine_id}  # Array filter for the wine
-        ]
-    )
+        {"$sort": {"_id": 1}}
+    ]
+    return pipeline
 
-    # Step 2: If the wine_id doesn't exist, check if the location exists
-    if result.matched_count == 0:
-        # Try to add the wine to an existing location
-        result = warehouses_collection.update_one(
-            {
-                "_id": warehouse_id,  # Match the warehouse
-                "aisles.aisle": aisle,  # Match the aisle
-                "aisles.shelves.shelf": shelf  # Match the shelf
-            },
-            {
-                "$addToSet": {  # Add the new wine
-                    "aisles.$[aisle].shelves.$[shelf].wines": {
-                        "wine_id": wine_id,
-                        "stock": stock_to_add
-                    }
-                }
-            },
-            array_filters=[
-                {"aisle.aisle": aisle},  # Array filter for the aisle
-                {"shelf.shelf": shelf}  # Array filter for the shelf
-            ]
-        )
-
-        # Step 3: If the location itself doesn't exist, create it
-        if result.matched_count == 0:
-            result = warehouses_collection.update_one(
-                {"_id": warehouse_id},  # Match the warehouse
-                {
-                    "$addToSet": {  # Add a new aisle and shelf with the wine
-                        "aisles": {
-                            "aisle": aisle,
-                            "shelves": [
-                                {
-                                    "shelf": shelf,
-                                    "wines": [
-                                        {"wine_id": wine_id, "stock": stock_to_add}
-                                    ]
-                                }
-                            ]
+#function to build the replenishment report pipeline, run on the wines collection
+def build_replenishment_pipeline(
+    warehouses_collection,
+    sales_collection,
+    purchases_collection,
+    window_days: int,
+    stock_threshold: int = None,
+    days_of_cover: float = None,
+    skip: int = 0,
+    limit: int = 50) -> list:
+    """
+    Build a single aggregation joining, per wine, the total stock from the warehouses,
+    the units sold in the last window_days from the sales and the last cost price from the purchases.
+    The three sources are appended to the wines with $unionWith and grouped once by wine_id.
+    :param warehouses_collection: The MongoDB collection for warehouses.
+    :param sales_collection: The MongoDB collection for sales.
+    :param purchases_collection: The MongoDB collection for purchases.
+    :param window_days: Number of days of sales used for the sales velocity.
+    :param stock_threshold: Report wines with this stock or less.
+    :param days_of_cover: Report wines whose stock lasts fewer days than this at the current velocity.
+    :param skip: Number of report rows to skip.
+    :param limit: Number of report rows to return.
+    :return: Aggregation pipeline returning the total count and one page of the report.
+    """
+    since = str(datetime.utcnow() - timedelta(days=window_days))  # Same format as sales_date
+
+    conditions = []
+    if stock_threshold is not None:
+        conditions.append({"stock": {"$lte": stock_threshold}})
+    if days_of_cover is not None:
+        conditions.append({"days_of_cover": {"$lt": days_of_cover}})
+
+    return [
+        {"$project": {"_id": 0, "wine_id": {"$toString": "$_id"}, "name": 1, "in_catalog": {"$literal": 1}}},
+        {"$unionWith": {"coll": warehouses_collection.name, "pipeline": [
+            {"$unwind": "$aisles"},  # Unwind aisles array
+            {"$unwind": "$aisles.shelves"},  # Unwind shelves array
+            {"$unwind": "$aisles.shelves.wines"},  # Unwind wines array
+            {"$project": {"_id": 0, "wine_id": "$aisles.shelves.wines.wine_id", "stock": "$aisles.shelves.wines.stock"}}
+        ]}},
+        {"$unionWith": {"coll": sales_collection.name, "pipeline": [
+            {"$match": {"sales_date": {"$gte": since}}},
+            {"$unwind": "$items"},
+            {"$project": {"_id": 0, "wine_id": "$items.wine_id", "sold": "$items.quantity"}}
+        ]}},
+        {"$unionWith": {"coll": purchases_collection.name, "pipeline": [
+            {"$project": {"_id": 0, "wine_id": {"$toString": "$wine_id"}, "last_purchase": {"date": "$date", "cost_price": "$cost_price"}}}
+        ]}},
+        {
+            "$group": {
+                "_id": "$wine_id",
+                "name": {"$max": "$name"},
+                "in_catalog": {"$max": "$in_catalog"},
+                "stock": {"$sum": "$stock"},
+                "sold": {"$sum": "$sold"},
+                "last_purchase": {"$max": "$last_purchase"}  # Latest purchase, documents compare by date first
+            }
+        },
+        {"$match": {"in_catalog": 1}},  # Skip stock, sales and purchases of deleted wines
+        {"$addFields": {"daily_sales": {"$divide": ["$sold", window_days]}}},
+        {"$addFields": {"days_of_cover": {"$cond": [
+            {"$gt": ["$daily_sales", 0]}, {"$divide": ["$stock", "$daily_sales"]}, None
+        ]}}},
+        {"$match": {"$or": conditions}} if conditions else {"$match": {}},
+        # Wines without sales have no days_of_cover and sort after every wine that is selling
+        {"$addFields": {"no_velocity": {"$cond": [{"$eq": [{"$ifNull": ["$days_of_cover", None]}, None]}, 1, 0]}}},
+        {"$sort": {"no_velocity": 1, "days_of_cover": 1, "stock": 1, "_id": 1}},
+        {
+            "$facet": {
+                "total": [{"$count": "count"}],
+                "wines": [
+                    {"$skip": skip},
+                    {"$limit": limit},
+                    {
+                        "$project": {
+                            "_id": 0,
+                            "wine_id": "$_id",
+                            "name": 1,
+                            "stock": 1,
+                            "sold": 1,
+                            "daily_sales": {"$round": ["$daily_sales", 2]},
+                            "days_of_cover": {"$round": ["$days_of_cover", 1]},
+                            "last_cost_price": "$last_purchase.cost_price",
+                            "last_purchase_date": "$last_purchase.date"
                         }
                     }
-                }
-            )
+                ]
+            }
+        }
+    ]
 
-            if result.matched_count == 0:
-                return {"success": False, "message": "Warehouse not found."}
+def init_stock_manager_routes(
+    wines_collection,
+    warehouses_collection,
+    reservations_collection,
+    sales_collection,
+    purchases_collection,
+    reservation_ttl: int):
+    # Expired holds are removed by MongoDB; queries also ignore them until then
+    reservations_collection.create_index("expires_at", expireAfterSeconds=0)
+    reservations_collection.create_index([("cart_id", 1), ("wine_id", 1)], unique=True)
+    reservations_collection.create_index([("wine_id", 1), ("expires_at", 1)])
 
-    # Step 4: Return success response
-    if result.modified_count > 0:
-        return {"success": True, "message": "Wine stock updated or added successfully."}
-    else:
-        return {"success": False, "message": "Operation failed, no changes were made."}
+    #Place or refresh a hold when an item goes into a cart
+    @stock_manager_bp.route('/reservations', methods=['POST'])
+    @validate_body(Reservation)
+    def create_reservation():
+        data = g.body
+        
+        cart_id = data["cart_id"]
+        wine_id = data["wine_id"]
+        quantity = data["quantity"]
+
+        with start_stock_session(reservations_collection) as session:
+            result = reserve_stock(
+                        warehouses_collection,
+                        reservations_collection,
+                        cart_id,
+                        wine_id,
+                        quantity,
+                        reservation_ttl,
+                        session)
+
+        if result["success"]:
+            return jsonify({
+                "message": "Stock reserved successfully",
+                "response_status": True,
+                "available_stock": result["stock"],
+                "expires_at": str(result["expires_at"])
+            }), 201
+        else:
+            return jsonify({
+                "message": "Insufficient stock",
+                "response_status": False,
+                "available_stock": result["stock"],
+                "requested_quantity": quantity
+            }), 409
+
+    #Get the active holds of a cart
+    @stock_manager_bp.route('/reservations/<cart_id>', methods=['GET'])
+    def get_reservations(cart_id):
+        reservations = get_cart_reservations(reservations_collection, cart_id)
+        return jsonify({
+            "cart_id": cart_id,
+            "items": [{"wine_id": wine_id, "quantity": quantity} for wine_id, quantity in reservations.items()]
+        }), 200
+
+    #Release the holds of a cart, or of a single wine with ?wine_id=
+    @stock_manager_bp.route('/reservations/<cart_id>', methods=['DELETE'])
+    @validate_query(ReservationReleaseQuery)
+    def delete_reservations(cart_id):
+        deleted_count = release_reservations(reservations_collection, cart_id, g.query.get('wine_id'))
+        return jsonify({
+            "message": "Reservations released successfully",
+            "released": deleted_count,
+            "response_status": True
+        }), 200
+
+    #Get the wines that need reordering, by stock threshold and/or days of cover
+    @stock_manager_bp.route('/stock/replenishment', methods=['GET'])
+    @validate_query(ReplenishmentQuery)
+    def get_replenishment_report():
+        window_days = g.query.get('window_days', 30)
+        stock_threshold = g.query.get('threshold')
+        days_of_cover = g.query.get('days_of_cover')
+        page = g.query.get('page', 1)
+        limit = g.query.get('limit', 50)
+
+        # Without criteria, report wines running out of stock
+        if stock_threshold is None and days_of_cover is None:
+            stock_threshold = 0
+
+        pipeline = build_replenishment_pipeline(
+                    warehouses_collection,
+                    sales_collection,
+                    purchases_collection,
+                    window_days,
+                    int(stock_threshold) if stock_threshold is not None else None,
+                    float(days_of_cover) if days_of_cover is not None else None,
+                    (page - 1) * limit,
+                    limit)
+        result = list(wines_collection.aggregate(pipeline, allowDiskUse=True))[0]
+
+        total_count = result["total"][0]["count"] if result["total"] else 0
+        for wine in result["wines"]:
+            if wine.get("last_purchase_date"):
+                wine["last_purchase_date"] = str(wine["last_purchase_date"])
+        return jsonify({
+            "page": page,
+            "limit": limit,
+            "window_days": window_days,
+            "total_count": total_count,
+            "total_pages": (total_count + limit - 1) // limit,
+            "wines": result["wines"]
+        }), 200
@@ -1,45 +1,61 @@
-from flask import Blueprint, jsonify, request
+import json
+import logging
+from flask import Blueprint, Response, g, jsonify, stream_with_context
 from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo.errors import OperationFailure, PyMongoError
 from bson.objectid import ObjectId
-from .stock_manager import update_wine_stock, get_warehouse_id
+from .stock_manager import apply_stock_intake, build_inventory_matrix_pipeline, get_warehouse_id, get_wines_locations_by_warehouse, notify_stock_change
+from .wine_fields import normalize_term
+from models.validation import validate_body, validate_query
+from models.warehouse_model import InventoryQuery, WarehouseStock, WineLocationsQuery, WineLocationsRequest
+from typing import List
+
+logger = logging.getLogger(__name__)
 
 warehouses_bp = Blueprint('warehouse', __name__)
 
-def init_warehouse_routes(warehouses_collection):
+def init_warehouse_routes(warehouses_collection, wines_collection, locations_stream_threshold):
+    # One warehouse per location, so concurrent intakes can't create duplicates
+    try:
+        warehouses_collection.create_index("location", unique=True)
+    except OperationFailure:
+        logger.error("Warehouses share a location, run python -m migrations.merge_duplicate_warehouses")
+
     #Update wine stock at the warehouse
     @warehouses_bp.route('/warehouse', methods=['POST'])
+    @validate_body(WarehouseStock)
     def update_warehouse_stock():
-        data = request.get_json()
+        data = g.body
         
         location = data.get("location")
-        location_id = get_warehouse_id(warehouses_collection, location)
         aisles = data.get("aisles")
     
-        first_aisle = aisles[0]  # Access the first element in the list
-        aisle = first_aisle.get("aisle")
-        shelves = first_aisle.get("shelves")
-        
-        first_shelf = shelves[0]
-        shelf = first_shelf.get('shelf')
-        wines = first_shelf.get('wines')
+        # Flatten every aisle, shelf and wine of the payload into stock slots
+        slots = []
+        for aisle in aisles:
+            for shelf in aisle.get("shelves", []):
+                for wine in shelf.get("wines", []):
+                    slots.append({
+                        "aisle": aisle.get("aisle"),
+                        "shelf": shelf.get("shelf"),
+                        "wine_id": wine.get("wine_id"),
+                        "stock": int(wine.get("stock"))
+                    })
         
-        first_wine = wines[0]
-        wine_id = first_wine.get('wine_id')
-        stock_to_add = int(first_wine.get('stock'))
-        
-        #function to update stock in the required warehouse location
-        result = update_wine_stock(
-                    warehouses_collection,
-                    location_id,
-                    aisle,
-                    shelf,
-                    wine_id,
-                    stock_to_add)
+        try:
+            location_id = get_warehouse_id(warehouses_collection, location)
+            if data.get("coordinates"):
+                warehouses_collection.update_one({"_id": location_id}, {"$set": {"coordinates": data["coordinates"]}})
+
+            #function to update stock in every required warehouse location
+            result = apply_stock_intake(warehouses_collection, location_id, slots)
+        except PyMongoError as e:
+            result = {"success": False, "message": str(e)}
                     
         if result["success"]:
             return jsonify({
                 "message": "New stock registered successfully",
+                "slots_updated": len(slots),
                 "response_status": True
             }), 201
         else:
@@ -49,16 +65,88 @@ def init_warehouse_routes(warehouses_collection):
             }), 500
             
 
+    #Get the locations and stock of many wines, grouped by warehouse in pick path order
+    @warehouses_bp.route('/warehouse/locations', methods=['POST'])
+    @validate_body(WineLocationsRequest)
+    @validate_query(WineLocationsQuery)
+    def get_wines_locations():
+        wine_ids = list(dict.fromkeys(g.body["wine_ids"]))
+
+        warehouses = get_wines_locations_by_warehouse(warehouses_collection, wine_ids)
+
+        # Large requests are streamed as one JSON line per warehouse, ending with the wines not found
+        if g.query.get('stream') or len(wine_ids) > locations_stream_threshold:
+            def generate():
+                found = set()
+                for warehouse in warehouses:
+                    found.update(pick["wine_id"] for pick in warehouse["picks"])
+                    yield json.dumps(warehouse) + "\n"
+                yield json.dumps({"missing": [wine_id for wine_id in wine_ids if wine_id not in found]}) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        warehouses = list(warehouses)
+        found = {pick["wine_id"] for warehouse in warehouses for pick in warehouse["picks"]}
+        return jsonify({
+            "warehouses": warehouses,
+            "missing": [wine_id for wine_id in wine_ids if wine_id not in found]
+        }), 200
+
+    #Get the stock of every wine in every warehouse as a columnar matrix
+    @warehouses_bp.route('/warehouse/inventory', methods=['GET'])
+    @validate_query(InventoryQuery)
+    def get_inventory_matrix():
+        # Columns: the warehouses, optionally narrowed by location
+        warehouse_query = {}
+        if g.query.get('warehouse'):
+            warehouse_query["location"] = {"$in": [location.strip() for location in g.query['warehouse'].split(",")]}
+        warehouses = list(warehouses_collection.find(warehouse_query, {"location": 1}).sort("location", 1))
+        columns = {warehouse["_id"]: index for index, warehouse in enumerate(warehouses)}
+
+        # Rows: the wines, optionally narrowed by type through the indexed normalized field
+        wine_ids = None
+        if g.query.get('type'):
+            types = [normalize_term(wine_type) for wine_type in g.query['type'].split(",")]
+            wine_ids = [str(wine["_id"]) for wine in wines_collection.find({"type_norm": {"$in": types}}, {"_id": 1})]
+
+        # Always restricted to the columns read above, so a warehouse created meanwhile can't add an unknown one
+        pipeline = build_inventory_matrix_pipeline(list(columns), wine_ids)
+        rows = warehouses_collection.aggregate(pipeline, allowDiskUse=True)
+
+        # Compressed sparse rows: the stock of row i is stock[indptr[i]:indptr[i + 1]], in columns indices[...]
+        row_ids = []
+        indptr = [0]
+        indices = []
+        stock = []
+        for row in rows:
+            row_ids.append(row["_id"])
+            for warehouse_id, quantity in zip(row["warehouse_ids"], row["stock"]):
+                indices.append(columns[warehouse_id])
+                stock.append(quantity)
+            indptr.append(len(indices))
+
+        response = {
+            "format": g.query.get('format', "sparse"),
+            "wine_ids": row_ids,
+            "warehouse_ids": [str(warehouse["_id"]) for warehouse in warehouses],
+            "warehouse_locations": [warehouse.get("location") for warehouse in warehouses],
+            "nonzero": len(stock)
+        }
+        if response["format"] == "dense":
+            dense = [[0] * len(warehouses) for _ in row_ids]
+            for row_index in range(len(row_ids)):
+                for position in range(indptr[row_index], indptr[row_index + 1]):
+                    dense[row_index][indices[position]] = stock[position]
+            response["stock"] = dense
+        else:
+            response.update({"indptr": indptr, "indices": indices, "stock": stock})
+        return jsonify(response), 200
+
     # Create initial list of stock
     @warehouses_bp.route('/warehouse/all', methods=['POST'])
+    @validate_body(List[WarehouseStock])
     def create_initial_stock():
-        data_list = request.json
-        
-        if not isinstance(data_list, list):
-            return jsonify({
-                "message": "Input data must be a list",
-                "response_status": False
-            }), 400
+        data_list = g.body
 
         def create_stock_list():
             stock_list = []
@@ -67,13 +155,15 @@ def init_warehouse_routes(warehouses_collection):
                     "location": data.get("location"),
                     "aisles": data.get("aisles")
                 }
+                if data.get("coordinates"):
+                    new_stock["coordinates"] = data["coordinates"]
                 stock_list.append(new_stock)
                 
             try:
                 result = warehouses_collection.insert_many(stock_list)
                 return stock_list
             except Exception as e:
-                return None, str(e)
+                return None
                 
         stock = create_stock_list()
         if not stock:
@@ -81,6 +171,15 @@ def init_warehouse_routes(warehouses_collection):
                 "message": "Error adding stock list",
                 "response_status": False
             }), 500
+
+        # Bump the stock caches and record the change for offline catalogs
+        notify_stock_change(list({
+            wine["wine_id"]
+            for warehouse in stock
+            for aisle in warehouse["aisles"]
+            for shelf in aisle.get("shelves", [])
+            for wine in shelf.get("wines", [])
+        }))
         
         # Prepare response stock list
         response = {
@@ -0,0 +1,99 @@
+import unicodedata
+
+#fields stored on wine documents but computed from other wine fields
+
+#categorical fields with a normalized shadow field used by exact filters
+NORMALIZED_FIELDS = {
+    "type": "type_norm",
+    "country": "country_norm",
+    "grapes": "grapes_norm",
+    "food_pair": "food_pair_norm"
+}
+
+#function to lowercase a term and fold its accents, e.g. "Sémillon" -> "semillon"
+def normalize_term(value) -> str:
+    decomposed = unicodedata.normalize("NFKD", str(value))
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).strip().lower()
+
+#function to normalize a categorical field value, keeping lists as lists
+def normalize_field(value):
+    if isinstance(value, list):
+        return [normalize_term(term) for term in value if term is not None]
+    if value is None:
+        return None
+    return normalize_term(value)
+
+#function to return the normalized shadow fields of the categorical fields present in a document
+def normalized_wine_fields(wine: dict) -> dict:
+    return {
+        shadow: normalize_field(wine[field])
+        for field, shadow in NORMALIZED_FIELDS.items()
+        if field in wine
+    }
+
+#function to compute the price of a wine after its discount
+def effective_price(sale_price, discount):
+    if not isinstance(sale_price, (int, float)):
+        return None
+    if not isinstance(discount, (int, float)):
+        discount = 0
+    return round(sale_price * (1 - discount), 2)
+
+#update pipeline stage recomputing the effective price from the stored fields
+EFFECTIVE_PRICE_STAGE = {
+    "$set": {
+        "effective_price": {
+            "$round": [{"$multiply": ["$sale_price", {"$subtract": [1, {"$ifNull": ["$discount", 0]}]}]}, 2]
+        }
+    }
+}
+
+#bounds kept by incremented fields, matching the wine model
+INCREMENT_BOUNDS = {
+    "sale_price": (0, None),
+    "discount": (0, 1),
+    "rate": (0, None)
+}
+
+#function to build the expression adding an amount to a numeric wine field
+def increment_expression(field: str, amount):
+    # A missing discount counts as no discount, as in the effective price
+    current = {"$ifNull": ["$discount", 0]} if field == "discount" else f"${field}"
+    expression = {"$add": [current, amount]}
+    low, high = INCREMENT_BOUNDS.get(field, (None, None))
+    if low is not None:
+        expression = {"$max": [low, expression]}
+    if high is not None:
+        expression = {"$min": [high, expression]}
+    # Values that aren't numbers are left as they are
+    return {"$cond": [{"$isNumber": current}, expression, current]}
+
+#function to return the derived fields of a complete wine document
+def derived_wine_fields(wine: dict) -> dict:
+    """
+    Compute the derived fields of a wine, so they can be indexed, filtered and sorted on.
+    :param wine: The wine document.
+    :return: Dictionary of derived field -> value.
+    """
+    derived = normalized_wine_fields({field: wine.get(field) for field in NORMALIZED_FIELDS})
+    derived["effective_price"] = effective_price(wine.get("sale_price"), wine.get("discount"))
+    return derived
+
+#function to build the update pipeline that sets wine fields and keeps derived fields in sync
+def wine_update_pipeline(updated_data: dict, increments: dict = None) -> list:
+    """
+    Build an update pipeline setting the given fields and recomputing the derived fields.
+    Shadow fields are computed here from the updated fields, the effective price by the server.
+    Values are wrapped in $literal, so strings starting with $ aren't read as field paths.
+    :param updated_data: Dictionary of field -> new value.
+    :param increments: Optional dictionary of numeric field -> amount to add.
+    :return: Update pipeline.
+    """
+    updated_data = {**updated_data, **normalized_wine_fields(updated_data)}
+    changes = {key: {"$literal": value} for key, value in updated_data.items()}
+    for field, amount in (increments or {}).items():
+        changes[field] = increment_expression(field, amount)
+    return [
+        {"$set": changes},
+        EFFECTIVE_PRICE_STAGE
+    ]
@@ -1,123 +1,342 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, current_app, g, jsonify, send_file
+from bson import json_util
 from bson.objectid import ObjectId
+from pymongo import ReadPreference, UpdateMany
 from pymongo.errors import PyMongoError
-from .stock_manager import get_total_stock
+from .stock_manager import get_available_stock_for_wines, get_total_stock_for_wines
+from .wine_fields import NORMALIZED_FIELDS, derived_wine_fields, normalize_term, wine_update_pipeline
+from .wine_similarity import FEATURE_PROJECTION
+from .catalog_sync import SYNC_PROJECTION, WINE_CHANGE
+from models.validation import validate_body, validate_object_ids, validate_query
+from models.wine_model import CatalogChangesQuery, SimilarWinesQuery, Wine, WineBulkUpdate, WineFilterQuery, WineIdList, WinePatch, WineSearchQuery, WineTypeQuery
+from typing import List
 
 wines_bp = Blueprint('wines', __name__)
 
-def init_wine_routes(wines_collection, warehouses_collection):
+#harvest year and price ranges reported by the facet counts
+HARVEST_YEAR_BOUNDARIES = [1900, 1990, 2000, 2010, 2015, 2020, 2025, 2100]
+PRICE_BOUNDARIES = [0, 10, 20, 30, 50, 100, 1000000]
+
+#number of ids matched by each update of a bulk wine update
+BULK_UPDATE_CHUNK_SIZE = 1000
+
+#indexes supporting the sorts of GET /wines; a sort must be a prefix of one of them, or of its reverse
+SORT_INDEXES = [
+    [("sale_price", 1), ("_id", 1)],
+    [("effective_price", 1), ("_id", 1)],
+    [("rate", -1), ("effective_price", 1), ("_id", 1)],
+    [("harvest_year", -1), ("effective_price", 1), ("_id", 1)],
+    [("discount", -1), ("effective_price", 1), ("_id", 1)],
+    [("name", 1), ("_id", 1)]
+]
+SORT_FIELDS = {field for index in SORT_INDEXES for field, _ in index if field != "_id"}
+
+#function to parse the sort of GET /wines into an index-backed sort specification
+def parse_wine_sort(args) -> list:
+    """
+    Parse `sort=field:dir,...` (or the older `sort_price_order`) into a sort specification.
+    The requested fields are completed with the remaining keys of the index that supports
+    them, which gives deterministic tie-breaks and lets MongoDB walk the index instead of
+    sorting in memory.
+    :param args: The query parameters.
+    :return: List of (field, direction) pairs.
+    :raises ValueError: If the sort isn't supported by an index.
+    """
+    sort = args.get('sort')
+    if not sort:
+        # Sorting by price
+        sort_order = args.get('sort_price_order', 'asc')
+        sort = "sale_price:asc" if sort_order == 'asc' else "sale_price:desc"
+
+    requested = []
+    for part in sort.split(","):
+        field, _, direction = part.strip().partition(":")
+        if field not in SORT_FIELDS:
+            raise ValueError(f"Unsupported sort field: {field}")
+        if direction not in ("", "asc", "desc"):
+            raise ValueError(f"Unsupported sort direction: {direction}")
+        requested.append((field, -1 if direction == "desc" else 1))
+
+    for index in SORT_INDEXES:
+        reversed_index = [(field, -direction) for field, direction in index]
+        for candidate in (index, reversed_index):
+            if candidate[:len(requested)] == requested:
+                return candidate
+    raise ValueError(f"Unsupported sort combination: {sort}")
+
+#function to build the wine filter from the query parameters of GET /wines
+def build_wine_filter(args) -> dict:
+    # Initialize an empty filter dictionary
+    filter_criteria = {}
+
+    # Partial name filter
+    name_query = args.get('name')
+    if name_query:
+        filter_criteria['name'] = {"$regex": name_query, "$options": "i"}  # Case-insensitive regex
+
+    # Categorical filters: exact matches of comma-separated values on the normalized shadow fields
+    for param, field in (('type', 'type'), ('grape', 'grapes'), ('food_pair', 'food_pair'), ('country', 'country')):
+        values = args.get(param)
+        if values:
+            filter_criteria[NORMALIZED_FIELDS[field]] = {"$in": [normalize_term(value) for value in values.split(",")]}
+
+    # Harvest year range filter
+    min_harvest = args.get('min_harvest')
+    max_harvest = args.get('max_harvest')
+    if min_harvest is not None or max_harvest is not None:
+        filter_criteria['harvest_year'] = {}
+        if min_harvest is not None:
+            filter_criteria['harvest_year']['$gte'] = int(min_harvest)
+        if max_harvest is not None:
+            filter_criteria['harvest_year']['$lte'] = int(max_harvest)
+
+    # Producer filter
+    producer = args.get('producer')
+    if producer:
+        filter_criteria['producer'] = {"$regex": producer, "$options": "i"}
+
+    # Discount threshold filter
+    discount_threshold = args.get('discount')
+    if discount_threshold is not None:
+        filter_criteria['discount'] = {"$gte": float(discount_threshold)}
+
+    # Price range filter
+    min_price = args.get('min_price')
+    max_price = args.get('max_price')
+    if min_price is not None or max_price is not None:
+        filter_criteria['sale_price'] = {}
+        if min_price is not None:
+            filter_criteria['sale_price']['$gte'] = float(min_price)
+        if max_price is not None:
+            filter_criteria['sale_price']['$lte'] = float(max_price)
+
+    return filter_criteria
+
+#function to build the facet counts pipeline for a wine filter
+def build_facets_pipeline(filter_criteria: dict) -> list:
+    """
+    Build a single aggregation returning every catalog facet for the given filter.
+    Categorical facets are grouped on the normalized shadow fields the filters match on,
+    so each value counts every spelling it filters, with one of those spellings as label.
+    :param filter_criteria: The wine filter built by build_wine_filter.
+    :return: Aggregation pipeline.
+    """
+    def count_by(field, label):
+        return [
+            {"$group": {"_id": field, "label": {"$first": label}, "count": {"$sum": 1}}},
+            {"$sort": {"count": -1, "_id": 1}},
+            {"$project": {"_id": 0, "value": "$_id", "label": 1, "count": 1}}
+        ]
+
+    def count_ranges(field, boundaries):
+        return [
+            {"$bucket": {"groupBy": field, "boundaries": boundaries, "default": "other"}},
+            {"$project": {"_id": 0, "min": "$_id", "count": 1}}
+        ]
+
+    return [
+        {"$match": filter_criteria},
+        {
+            "$facet": {
+                "type": count_by("$type_norm", "$type"),
+                "country": count_by("$country_norm", "$country"),
+                "grape": [{"$unwind": {"path": "$grapes_norm", "includeArrayIndex": "grape_index"}}]
+                         + count_by("$grapes_norm", {"$arrayElemAt": ["$grapes", "$grape_index"]}),
+                "harvest_year": count_ranges("$harvest_year", HARVEST_YEAR_BOUNDARIES),
+                "price": count_ranges("$sale_price", PRICE_BOUNDARIES),
+                "total": [{"$count": "count"}]
+            }
+        }
+    ]
+
+def init_wine_routes(wines_collection, warehouses_collection, reservations_collection, similarity_index, query_cache, invalidation_bus,
+                     catalog_changes, catalog_snapshot, catalog_read_preference=ReadPreference.PRIMARY):
+    for index in SORT_INDEXES:
+        wines_collection.create_index(index)
+    for shadow in NORMALIZED_FIELDS.values():
+        wines_collection.create_index(shadow)
+
+    # Catalog browsing tolerates replication lag, so it can be served by secondaries; writes use the primary
+    catalog_wines = wines_collection.with_options(read_preference=catalog_read_preference)
+    catalog_warehouses = warehouses_collection.with_options(read_preference=catalog_read_preference)
+    catalog_reservations = reservations_collection.with_options(read_preference=catalog_read_preference)
     
+    #function to drop catalog results cached by this process, announce the write to the others and log it for synced clients
+    def invalidate_catalog_caches(wine_ids=None):
+        query_cache.bump("catalog")
+        invalidation_bus.publish("wines", wine_ids)
+        catalog_changes.record(WINE_CHANGE, wine_ids)
+
+    #function to return a cached JSON body, or compute and cache it
+    def cached_response(cache_key, tags, compute):
+        body = query_cache.get(cache_key)
+        if body is None:
+            versions = query_cache.versions(tags)
+            body = jsonify(compute()).get_data()
+            query_cache.set(cache_key, tags, versions, body)
+        return current_app.response_class(body, mimetype="application/json")
+
     @wines_bp.route('/wines', methods=['GET'])
+    @validate_query(WineFilterQuery)
     def get_wines():
-        # Initialize an empty filter dictionary
-        filter_criteria = {}
-
-        # Partial name filter
-        name_query = request.args.get('name')
-        if name_query:
-            filter_criteria['name'] = {"$regex": name_query, "$options": "i"}  # Case-insensitive regex
-
-        # Wine type filter
-        wine_types = request.args.get('type')
-        if wine_types:
-            wine_types_list = wine_types.split(",")
-            filter_criteria['$or'] = [{"type": {"$regex": f"^{wine_type.strip()}$", "$options": "i"}} for wine_type in wine_types_list]
-
-        # Grape filter
-        grape = request.args.get('grape')
-        if grape:
-            filter_criteria['grapes'] = {"$elemMatch": {"$regex": grape, "$options": "i"}}  # Case-insensitive regex
-
-        # Food pairing filter
-        food_pair = request.args.get('food_pair')
-        if food_pair:
-            filter_criteria['food_pair'] = {"$elemMatch": {"$regex": food_pair, "$options": "i"}}  # Case-insensitive regex
-
-        # Harvest year range filter
-        min_harvest = request.args.get('min_harvest')
-        max_harvest = request.args.get('max_harvest')
-        if min_harvest or max_harvest:
-            filter_criteria['harvest_year'] = {}
-            if min_harvest:
-                filter_criteria['harvest_year']['$gte'] = int(min_harvest)
-            if max_harvest:
-                filter_criteria['harvest_year']['$lte'] = int(max_harvest)
-
-        # Country filter
-        country = request.args.get('country')
-        if country:
-            filter_criteria['country'] = {"$regex": country, "$options": "i"}
-
-        # Producer filter
-        producer = request.args.get('producer')
-        if producer:
-            filter_criteria['producer'] = {"$regex": producer, "$options": "i"}
-
-        # Discount threshold filter
-        discount_threshold = request.args.get('discount')
-        if discount_threshold:
-            filter_criteria['discount'] = {"$gte": float(discount_threshold)}
-
-        # Price range filter
-        min_price = request.args.get('min_price')
-        max_price = request.args.get('max_price')
-        if min_price or max_price:
-            filter_criteria['sale_price'] = {}
-            if min_price:
-                filter_criteria['sale_price']['$gte'] = float(min_price)
-            if max_price:
-                filter_criteria['sale_price']['$lte'] = float(max_price)
+        # Build the filter from the query parameters
+        filter_criteria = build_wine_filter(g.query)
 
-        # Sorting by price
-        sort_order = request.args.get('sort_price_order', 'asc')
-        sort_direction = 1 if sort_order == 'asc' else -1
+        # Sorting by the requested fields
+        try:
+            sort = parse_wine_sort(g.query)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         # Pagination parameters
-        page = int(request.args.get('page', 1))
-        limit = int(request.args.get('limit', 10))
+        page = g.query.get('page', 1)
+        limit = g.query.get('limit', 10)
+        
+        # Pages depend on the catalog and on the stock of their wines
+        cache_key = ("wines", json_util.dumps(filter_criteria, sort_keys=True), tuple(sort), page, limit)
+        return cached_response(cache_key, ("catalog", "stock"), lambda: find_wines_page(filter_criteria, sort, page, limit))
+
+    #function to compute a page of GET /wines
+    def find_wines_page(filter_criteria, sort, page, limit):
         skip = (page - 1) * limit
 
         # Query MongoDB with the constructed filter, apply sorting and pagination
         wines = list(
-            wines_collection.find(filter_criteria)
-            .sort("sale_price", sort_direction)  # Apply sorting by price
+            catalog_wines.find(filter_criteria)
+            .sort(sort)  # Apply index-backed sorting
             .skip(skip)
             .limit(limit)
         )
 
         # Convert ObjectId to string for JSON serialization
-        # set stock in each wine
+        # set stock in each wine, with one aggregation for the whole page
+        stock = get_available_stock_for_wines(catalog_warehouses, catalog_reservations, [str(wine['_id']) for wine in wines])
         for wine in wines:
             wine['_id'] = str(wine['_id'])
-            wine['stock'] = get_total_stock(warehouses_collection, wine['_id'])
+            wine['stock'] = stock[wine['_id']]
 
         # Get the total count of wines matching the filter
-        total_count = wines_collection.count_documents(filter_criteria)
+        total_count = catalog_wines.count_documents(filter_criteria)
 
         # Prepare paginated response
-        response = {
+        return {
             "page": page,
             "limit": limit,
             "total_count": total_count,
             "total_pages": (total_count + limit - 1) // limit,
             "wines": wines
         }
-        return jsonify(response)
+
+    # Get filter facet counts for the catalog in a single aggregation
+    @wines_bp.route('/wines/facets', methods=['GET'])
+    @validate_query(WineFilterQuery)
+    def get_wine_facets():
+        filter_criteria = build_wine_filter(g.query)
+
+        # Facets only change on catalog writes, so they are cached per normalized filter
+        cache_key = ("facets", json_util.dumps(filter_criteria, sort_keys=True))
+        return cached_response(cache_key, ("catalog",), lambda: count_wine_facets(filter_criteria))
+
+    #function to compute the facet counts of a filter
+    def count_wine_facets(filter_criteria):
+        facets = list(catalog_wines.aggregate(build_facets_pipeline(filter_criteria)))[0]
+
+        # Report the upper bound of each range next to its lower bound
+        for field, boundaries in (("harvest_year", HARVEST_YEAR_BOUNDARIES), ("price", PRICE_BOUNDARIES)):
+            for bucket in facets[field]:
+                if bucket["min"] == "other":
+                    bucket["min"] = bucket["max"] = None
+                else:
+                    bucket["max"] = boundaries[boundaries.index(bucket["min"]) + 1]
+        facets["total"] = facets["total"][0]["count"] if facets["total"] else 0
+        return facets
+
+    # Download the compressed snapshot of the whole catalog, the starting point of /wines/changes
+    @wines_bp.route('/wines/snapshot', methods=['GET'])
+    def get_catalog_snapshot():
+        # A catalog reset makes older snapshots useless as a base for the changes
+        _, reset_version = catalog_changes.versions()
+        version, path = catalog_snapshot.ensure_current(reset_version)
+        response = send_file(path, mimetype="application/gzip", as_attachment=True,
+                             download_name=f"catalog-{version}.json.gz", conditional=True)
+        response.headers["X-Catalog-Version"] = str(version)
+        return response
+
+    # Get the wines and stock totals changed since a catalog version, with deleted wines as tombstones
+    @wines_bp.route('/wines/changes', methods=['GET'])
+    @validate_query(CatalogChangesQuery)
+    def get_catalog_changes():
+        changes = catalog_changes.changes_since(g.query["since"], g.query.get("limit", 1000))
+        if changes["expired"]:
+            return jsonify({
+                "message": "Version too old or catalog replaced, download /wines/snapshot",
+                "version": changes["version"],
+                "response_status": False
+            }), 410
+
+        # Read from the primary: a lagging secondary could miss changes the version already covers
+        wine_ids = changes["wine_ids"]
+        wines = list(wines_collection.find({"_id": {"$in": [ObjectId(wine_id) for wine_id in wine_ids]}}, SYNC_PROJECTION))
+        for wine in wines:
+            wine["_id"] = str(wine["_id"])
+        deleted = sorted(wine_ids - {wine["_id"] for wine in wines})
+
+        stock_ids = list((wine_ids | changes["stock_ids"]) - set(deleted))
+        # Total stock, as in the snapshot: hold expiries aren't recorded as changes
+        stock = get_total_stock_for_wines(warehouses_collection, stock_ids) if stock_ids else {}
+        for wine in wines:
+            wine["stock"] = stock.pop(wine["_id"], 0)
+
+        return jsonify({
+            "version": changes["version"],
+            "has_more": changes["has_more"],
+            "wines": wines,
+            "stock": stock,  # Wines whose stock changed but not their document
+            "deleted": deleted
+        }), 200
 
     # Get a single wine by ID
     @wines_bp.route('/wines/<id>', methods=['GET'])
+    @validate_object_ids('id')
     def get_wine(id):
-        wine = wines_collection.find_one({"_id": ObjectId(id)})
+        wine = catalog_wines.find_one({"_id": ObjectId(id)})
         if wine:
             wine['_id'] = str(wine['_id'])
-            wine['stock'] = get_total_stock(warehouses_collection, wine['_id']) #load stock from warehouse
+            wine['stock'] = get_available_stock_for_wines(catalog_warehouses, catalog_reservations, [wine['_id']])[wine['_id']] #load stock from warehouse
             return jsonify(wine)
         return jsonify({"error": "Wine not found"}), 404
 
+    # Get the wines most similar to a wine
+    @wines_bp.route('/wines/<id>/similar', methods=['GET'])
+    @validate_object_ids('id')
+    @validate_query(SimilarWinesQuery)
+    def get_similar_wines(id):
+        k = g.query.get('k', 10)
+        
+        similar = similarity_index.most_similar(id, k)
+        if similar is None:
+            return jsonify({"error": "Wine not found"}), 404
+        
+        wine_ids = [wine_id for wine_id, _ in similar]
+        wines = {str(wine["_id"]): wine for wine in catalog_wines.find({"_id": {"$in": [ObjectId(wine_id) for wine_id in wine_ids]}})}
+        stock = get_available_stock_for_wines(catalog_warehouses, catalog_reservations, wine_ids)
+        
+        # Keep the similarity order, skipping wines deleted meanwhile
+        results = []
+        for wine_id, similarity in similar:
+            wine = wines.get(wine_id)
+            if wine:
+                wine['_id'] = wine_id
+                wine['similarity'] = round(similarity, 4)
+                wine['stock'] = stock[wine_id]
+                results.append(wine)
+        return jsonify(results)
+
     # Create a new wine.
     @wines_bp.route('/wines', methods=['POST'])
+    @validate_body(Wine)
     def create_wine():
-        data = request.json
+        data = g.body
         
         # Function to create new wine
         def create_wine(data):
@@ -138,9 +357,12 @@ def init_wine_routes(wines_collection, warehouses_collection):
                 "discount": data.get("discount"),
                 "stock": data.get("stock")
             }
+            new_wine.update(derived_wine_fields(new_wine))
             try:
                 result = wines_collection.insert_one(new_wine)
+                similarity_index.upsert(new_wine)
                 new_wine["_id"] = str(result.inserted_id) #Convert ObjectId to string
+                invalidate_catalog_caches([new_wine["_id"]])
                 return new_wine
             except Exception as e:
                 return None, str(e)
@@ -162,19 +384,69 @@ def init_wine_routes(wines_collection, warehouses_collection):
 
     # Update an existing wine
     @wines_bp.route('/wines/<id>', methods=['PATCH'])
+    @validate_object_ids('id')
+    @validate_body(WinePatch)
     def update_wine(id):
-        data = request.json
+        data = g.body
         updated_data = {key: value for key, value in data.items() if value is not None}
-        result = wines_collection.update_one({"_id": ObjectId(id)}, {"$set": updated_data})
+        result = wines_collection.update_one({"_id": ObjectId(id)}, wine_update_pipeline(updated_data))
         if result.modified_count:
+            similarity_index.refresh(id)
+            invalidate_catalog_caches([id])
             return jsonify({"message": "Wine updated successfully"})
         return jsonify({"error": "Wine not found or no changes made"}), 404
 
+    # Update many wines at once, e.g. the prices of a campaign
+    @wines_bp.route('/wines/bulk', methods=['PATCH'])
+    @validate_body(WineBulkUpdate)
+    def update_wines_bulk():
+        data = g.body
+        # set and inc may be sent as explicit nulls, and their fields too
+        updated_data = {key: value for key, value in (data.get("set") or {}).items() if value is not None}
+        increments = {key: value for key, value in (data.get("inc") or {}).items() if value is not None}
+        if not updated_data and not increments:
+            return jsonify({"error": "set or inc must change at least one field"}), 400
+        pipeline = wine_update_pipeline(updated_data, increments)
+
+        try:
+            if "wine_ids" in data:
+                wine_ids = list(dict.fromkeys(data["wine_ids"]))
+            else:
+                # Resolve the filter to ids first, so the change log knows which wines changed
+                wine_ids = [str(wine["_id"]) for wine in wines_collection.find(build_wine_filter(data["filter"]), {"_id": 1})]
+
+            # One bulk write for the whole list, matching a chunk of ids per update
+            operations = [
+                UpdateMany({"_id": {"$in": [ObjectId(wine_id) for wine_id in wine_ids[start:start + BULK_UPDATE_CHUNK_SIZE]]}}, pipeline)
+                for start in range(0, len(wine_ids), BULK_UPDATE_CHUNK_SIZE)
+            ]
+            result = wines_collection.bulk_write(operations, ordered=False) if operations else None
+        except PyMongoError as e:
+            return jsonify({"error": f"Failed to update wines: {str(e)}"}), 500
+
+        matched_count = result.matched_count if result else 0
+        modified_count = result.modified_count if result else 0
+        if modified_count:
+            # Rows of the similarity index only change with the features, reloaded with one find
+            if set(updated_data).union(increments) & set(FEATURE_PROJECTION):
+                similarity_index.refresh_many(wine_ids)
+            invalidate_catalog_caches(wine_ids)
+
+        return jsonify({
+            "message": "Wines updated successfully",
+            "matched_count": matched_count,
+            "modified_count": modified_count,
+            "response_status": True
+        }), 200
+
     # Delete a wine
     @wines_bp.route('/wines/<id>', methods=['DELETE'])
+    @validate_object_ids('id')
     def delete_wine(id):
         result = wines_collection.delete_one({"_id": ObjectId(id)})
         if result.deleted_count:
+            similarity_index.remove(id)
+            invalidate_catalog_caches([id])
             return jsonify({
                 "message": "Wine deleted successfully",
                 "response_status": True
@@ -186,20 +458,22 @@ def init_wine_routes(wines_collection, warehouses_collection):
 
     # Search wines by partial name with pagination
     @wines_bp.route('/wines/search', methods=['GET'])
+    @validate_query(WineSearchQuery)
     def search_wines():
-        query = request.args.get('q', '')  # 'q' is the search term
-        page = int(request.args.get('page', 1))  # Default to page 1
-        limit = int(request.args.get('limit', 10))  # Default to 10 items per page
+        query = g.query.get('q', '')  # 'q' is the search term
+        page = g.query.get('page', 1)  # Default to page 1
+        limit = g.query.get('limit', 10)  # Default to 10 items per page
         skip = (page - 1) * limit
 
         # Query MongoDB with regex and pagination
-        wines = list(wines_collection.find({"name": {"$regex": query, "$options": "i"}}).skip(skip).limit(limit))
+        wines = list(catalog_wines.find({"name": {"$regex": query, "$options": "i"}}).skip(skip).limit(limit))
+        stock = get_available_stock_for_wines(catalog_warehouses, catalog_reservations, [str(wine['_id']) for wine in wines])
         for wine in wines:
             wine['_id'] = str(wine['_id'])
-            wine['stock'] = get_total_stock(warehouses_collection, wine['_id'])
+            wine['stock'] = stock[wine['_id']]
 
         # Get total count of wines matching the search query
-        total_count = wines_collection.count_documents({"name": {"$regex": query, "$options": "i"}})
+        total_count = catalog_wines.count_documents({"name": {"$regex": query, "$options": "i"}})
 
         # Prepare paginated response
         response = {
@@ -213,24 +487,25 @@ def init_wine_routes(wines_collection, warehouses_collection):
 
     # Filter wines by type
     @wines_bp.route('/wines/filter', methods=['GET'])
+    @validate_query(WineTypeQuery)
     def filter_wines_by_type():
-        wine_type = request.args.get('type')
-        wines = list(wines_collection.find({"type": wine_type}))
+        wine_type = g.query.get('type')
+        wines = list(catalog_wines.find({"type": wine_type}))
+        stock = get_available_stock_for_wines(catalog_warehouses, catalog_reservations, [str(wine['_id']) for wine in wines])
         for wine in wines:
             wine['_id'] = str(wine['_id'])
-            wine['stock'] = get_total_stock(warehouses_collection, wine['_id'])
+            wine['stock'] = stock[wine['_id']]
         return jsonify(wines)
 
     # Remove all wines and create initial list
     @wines_bp.route('/wines/all', methods=['POST'])
+    @validate_body(List[Wine])
     def create_initial_wines():
         
         #function to delete all existing wines on wine_warehouse
         delete_all_wines()
         
-        data_list = request.json
-        if not isinstance(data_list, list):
-            return jsonify({"error": "Input data must be a list"}), 400
+        data_list = g.body
         wine_list = []
         for data in data_list:
             new_wine = {
@@ -250,9 +525,12 @@ def init_wine_routes(wines_collection, warehouses_collection):
                 "discount": data.get("discount"),
                 "stock": data.get("stock")
             }
+            new_wine.update(derived_wine_fields(new_wine))
             wine_list.append(new_wine)
         try:
             result = wines_collection.insert_many(wine_list)
+            similarity_index.rebuild()
+            invalidate_catalog_caches()
             if result.inserted_ids:
                 return jsonify({"message": "List of wines created successfully"}), 201
         except PyMongoError as e:
@@ -263,29 +541,31 @@ def init_wine_routes(wines_collection, warehouses_collection):
     @wines_bp.route('/wines', methods=['DELETE'])
     def delete_all_wines():
         result = wines_collection.delete_many({})
+        similarity_index.rebuild()
+        invalidate_catalog_caches()
         if result.deleted_count > 0:
             return jsonify({"message": "All wines deleted successfully"}), 200
         return jsonify({"error": "No wines found to delete"}), 404
     
     #get wines by ids
     @wines_bp.route('/wines/bulk', methods=['POST'])
+    @validate_body(WineIdList)
     def get_wines_by_ids():
         try:
             # Retrieve the list of wine IDs from the request
-            wine_ids = request.json.get("wine_ids", [])
-            if not wine_ids:
-                return jsonify({"error": "No wine IDs provided"}), 400
+            wine_ids = g.body["wine_ids"]
 
             # Convert string IDs to ObjectId for MongoDB query
             object_ids = [ObjectId(wine_id) for wine_id in wine_ids]
 
             # Query MongoDB for wines with the provided IDs
-            wines = list(wines_collection.find({"_id": {"$in": object_ids}}))
+            wines = list(catalog_wines.find({"_id": {"$in": object_ids}}))
 
-            # Convert ObjectId to string for JSON serialization
+            # Convert ObjectId to string for JSON serialization, with the stock of all wines read at once
+            stock = get_available_stock_for_wines(catalog_warehouses, catalog_reservations, [str(wine['_id']) for wine in wines])
             for wine in wines:
                 wine['_id'] = str(wine['_id'])
-                wine['stock'] = get_total_stock(warehouses_collection, wine['_id'])
+                wine['stock'] = stock[wine['_id']]
 
             return jsonify(wines), 200
 
@@ -0,0 +1,222 @@
+import math
+import threading
+import numpy as np
+import scipy.sparse as sp
+from bson.objectid import ObjectId
+
+#wine fields read to build the feature vectors
+FEATURE_PROJECTION = {"type": 1, "country": 1, "grapes": 1, "food_pair": 1, "taste_characteristics": 1, "sale_price": 1}
+
+#weight of each group of features in the similarity
+FEATURE_WEIGHTS = {"type": 2.0, "country": 1.0, "grape": 1.5, "food": 1.0, "taste": 1.0, "price": 1.0}
+
+#function to turn a str, list or dict field into a list of lowercase terms
+def _terms(value) -> list:
+    if isinstance(value, str):
+        value = value.split(",")
+    if isinstance(value, dict):
+        value = [key for key, present in value.items() if present]
+    if not isinstance(value, list):
+        return []
+    return [str(term).strip().lower() for term in value if str(term).strip()]
+
+#function to compute the weighted features of a wine
+def wine_features(wine: dict) -> dict:
+    """
+    Compute the sparse feature vector of a wine.
+    Every group is scaled by the square root of its size, so long lists of grapes or
+    food pairings don't outweigh the other groups.
+    :param wine: Wine document with the fields of FEATURE_PROJECTION.
+    :return: Dictionary of feature name -> weight.
+    """
+    groups = {
+        "type": _terms(wine.get("type")),
+        "country": _terms(wine.get("country")),
+        "grape": _terms(wine.get("grapes")),
+        "food": _terms(wine.get("food_pair")),
+        "taste": _terms(wine.get("taste_characteristics"))
+    }
+
+    features = {}
+    for group, terms in groups.items():
+        for term in terms:
+            features[f"{group}:{term}"] = FEATURE_WEIGHTS[group] / math.sqrt(len(terms))
+
+    # Price bands on a log scale, neighbouring bands count half
+    price = wine.get("sale_price")
+    if isinstance(price, (int, float)) and price > 0:
+        band = int(math.floor(math.log2(price)))
+        features[f"price:{band}"] = FEATURE_WEIGHTS["price"]
+        features[f"price:{band - 1}"] = FEATURE_WEIGHTS["price"] / 2
+        features[f"price:{band + 1}"] = FEATURE_WEIGHTS["price"] / 2
+
+    return features
+
+
+class WineSimilarityIndex:
+    """
+    In-memory sparse feature matrix of the catalog, one L2-normalized row per wine, so the
+    cosine similarity of a wine to every other wine is a single sparse matrix-vector product.
+    Rows are kept in CSR form; wines added, replaced or removed since the matrix was built
+    are scored from their own vectors until enough accumulate to rebuild it.
+    Every worker process holds its own copy: about 8 bytes per feature of every wine for
+    the matrix plus as much again for the per-wine vectors, e.g. roughly 40 MB for
+    100,000 wines with 25 features each, instead of a dense wines x vocabulary array.
+    """
+
+    def __init__(self, wines_collection, max_stale_rows: int = 256, max_refresh: int = 1000):
+        self.wines_collection = wines_collection
+        self.max_stale_rows = max_stale_rows
+        self.max_refresh = max_refresh
+        self._lock = threading.Lock()
+        self._built = False
+        self._reset()
+
+    def _reset(self):
+        self._columns = {}  # feature name -> column
+        self._ids = []  # row -> wine_id
+        self._rows = {}  # wine_id -> row
+        self._vectors = {}  # wine_id -> (columns, weights) of its normalized row
+        self._matrix = sp.csr_matrix((0, 0), dtype=np.float32)
+        self._stale = set()  # rows changed since the matrix was built
+
+    #function to load every wine of the catalog into the matrix
+    def rebuild(self):
+        wines = list(self.wines_collection.find({}, FEATURE_PROJECTION))
+        with self._lock:
+            self._reset()
+            for wine in wines:
+                self._upsert(str(wine["_id"]), wine_features(wine))
+            self._build_matrix()
+            self._built = True
+
+    #function to drop the matrix, so the next use rebuilds it
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+            self._reset()
+
+    def ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    #function to add or replace the row of a wine
+    def upsert(self, wine: dict):
+        if not self._built:
+            return  # The first rebuild will read it
+        features = wine_features(wine)
+        with self._lock:
+            self._upsert(str(wine["_id"]), features)
+
+    #function to reload the row of a wine from the database
+    def refresh(self, wine_id: str):
+        wine = self.wines_collection.find_one({"_id": ObjectId(wine_id)}, FEATURE_PROJECTION)
+        if wine:
+            self.upsert(wine)
+        else:
+            self.remove(wine_id)
+
+    #function to reload the rows of many wines with one query
+    def refresh_many(self, wine_ids: list):
+        """
+        Reload the rows of many wines from the database with a single find.
+        Above max_refresh wines the matrix is dropped instead, to be rebuilt on next use.
+        :param wine_ids: The wines that changed.
+        """
+        if not self._built:
+            return  # The first rebuild will read them
+        wine_ids = list(dict.fromkeys(str(wine_id) for wine_id in wine_ids))
+        if len(wine_ids) > self.max_refresh:
+            self.invalidate()
+            return
+
+        found = set()
+        for wine in self.wines_collection.find({"_id": {"$in": [ObjectId(wine_id) for wine_id in wine_ids]}}, FEATURE_PROJECTION):
+            self.upsert(wine)
+            found.add(str(wine["_id"]))
+        for wine_id in wine_ids:
+            if wine_id not in found:
+                self.remove(wine_id)
+
+    #function to remove the row of a wine
+    def remove(self, wine_id: str):
+        with self._lock:
+            row = self._rows.pop(str(wine_id), None)
+            if row is None:
+                return
+            self._vectors.pop(str(wine_id))
+            # Move the last row into the freed one
+            last = len(self._ids) - 1
+            if row != last:
+                self._ids[row] = self._ids[last]
+                self._rows[self._ids[row]] = row
+                self._stale.add(row)
+            self._ids.pop()
+            self._stale.discard(last)
+
+    def _upsert(self, wine_id: str, features: dict):
+        for feature in features:
+            if feature not in self._columns:
+                self._columns[feature] = len(self._columns)
+
+        row = self._rows.get(wine_id)
+        if row is None:
+            row = len(self._ids)
+            self._ids.append(wine_id)
+            self._rows[wine_id] = row
+
+        columns = np.fromiter((self._columns[feature] for feature in features), dtype=np.int32, count=len(features))
+        weights = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+        norm = np.linalg.norm(weights)
+        if norm > 0:
+            weights /= norm
+        self._vectors[wine_id] = (columns, weights)
+        self._stale.add(row)
+
+    #function to rebuild the CSR matrix from the vectors of every wine
+    def _build_matrix(self):
+        vectors = [self._vectors[wine_id] for wine_id in self._ids]
+        indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+        np.cumsum([len(columns) for columns, _ in vectors], out=indptr[1:])
+        indices = np.concatenate([columns for columns, _ in vectors]) if vectors else np.zeros(0, dtype=np.int32)
+        data = np.concatenate([weights for _, weights in vectors]) if vectors else np.zeros(0, dtype=np.float32)
+        self._matrix = sp.csr_matrix((data, indices, indptr), shape=(len(vectors), len(self._columns)))
+        self._stale = set()
+
+    #function to return the wines most similar to a wine
+    def most_similar(self, wine_id: str, k: int = 10) -> list:
+        """
+        Find the k wines with the highest cosine similarity to a wine.
+        :param wine_id: The wine to compare with.
+        :param k: Number of wines to return.
+        :return: List of (wine_id, similarity) pairs, most similar first, or None if the wine isn't indexed.
+        """
+        self.ensure_built()
+        with self._lock:
+            row = self._rows.get(str(wine_id))
+            if row is None:
+                return None
+            if len(self._stale) > self.max_stale_rows:
+                self._build_matrix()
+
+            count = len(self._ids)
+            query = np.zeros(len(self._columns), dtype=np.float32)
+            columns, weights = self._vectors[str(wine_id)]
+            query[columns] = weights
+
+            # Rows of the matrix, then the rows changed since it was built from their own vectors
+            similarities = np.zeros(count, dtype=np.float32)
+            built = min(count, self._matrix.shape[0])
+            similarities[:built] = (self._matrix @ query[:self._matrix.shape[1]])[:built]
+            for stale_row in self._stale:
+                columns, weights = self._vectors[self._ids[stale_row]]
+                similarities[stale_row] = weights @ query[columns]
+            ids = list(self._ids)
+
+        similarities[row] = -np.inf  # Skip the wine itself
+        k = min(k, count - 1)
+        if k <= 0:
+            return []
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(ids[index], float(similarities[index])) for index in top]
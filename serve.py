@@ -0,0 +1,56 @@
+"""
+Production entry point: serves the app with gunicorn's preforking server.
+
+    python serve.py
+
+Worker processes, threads, keep-alive and recycling are set in Config.
+SIGTERM drains in-flight requests and stops; SIGHUP starts a full new set of
+workers with the reloaded code, then stops the old ones with the same drain,
+for zero-downtime deploys (briefly running twice the workers and connections).
+"""
+from gunicorn.app.base import BaseApplication
+from config import Config
+
+
+#function run in each worker once the app is loaded, before it accepts connections
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up()
+
+#function run in each worker as it exits, after its requests are drained
+def worker_exit(server, worker):
+    from app import invoice_writer
+    invoice_writer.close()
+
+
+class WineWarehouseServer(BaseApplication):
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Imported in each worker, so every worker gets its own MongoDB client and background threads
+        from app import app
+        return app
+
+
+if __name__ == '__main__':
+    WineWarehouseServer({
+        "bind": Config.BIND,
+        "workers": Config.WORKERS,
+        "worker_class": "gthread",
+        "threads": Config.THREADS,
+        "keepalive": Config.KEEPALIVE,
+        "max_requests": Config.MAX_REQUESTS,
+        "max_requests_jitter": Config.MAX_REQUESTS_JITTER,
+        "timeout": Config.TIMEOUT,
+        "graceful_timeout": Config.GRACEFUL_TIMEOUT,
+        "preload_app": False,
+        "post_worker_init": post_worker_init,
+        "worker_exit": worker_exit
+    }).run()